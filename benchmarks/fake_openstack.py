@@ -0,0 +1,463 @@
+"""Local stand-in for the OpenStack APIs used by the harvester.
+
+A single HTTP server emulates, for any number of sites, Keystone (OIDC
+federation and project scoped tokens), Nova, Glance, Neutron and Cinder.
+URLs have the form:
+
+    /site{i}/identity/...             Keystone
+    /site{i}/region{r}/{service}/...  Nova, Glance, Neutron or Cinder
+
+Latency, catalog sizes and error rate are configurable. Every request is
+counted by resource type; counters are exposed at /_stats.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+NAMESPACE = uuid.UUID("6f2b1c3e-4c1a-4d0e-9a51-1f0c2e7d9b10")
+UPDATED_AT = "2024-01-01T00:00:00Z"
+
+
+def project_id(site: int, project: int) -> str:
+    """Return the deterministic ID of a project of a site."""
+    return uuid.uuid5(NAMESPACE, f"site{site}-project{project}").hex
+
+
+def region_name(region: int) -> str:
+    """Return the name of a region."""
+    return f"region{region}"
+
+
+class FakeOpenstackConfig(NamedTuple):
+    sites: int = 1
+    regions: int = 1
+    projects: int = 1
+    flavors: int = 20
+    private_flavors: float = 0.5
+    images: int = 50
+    shared_images: float = 0.2
+    networks: int = 5
+    latency: float = 0.0
+    error_rate: float = 0.0
+    seed: int = 0
+
+
+VERSIONS = {
+    "compute": [("v2.1", "2.1", "2.79")],
+    "image": [("v2", None, None)],
+    "network": [("v2.0", None, None)],
+    "volume": [("v3", "3.0", "3.70")],
+    "identity": [("v3", None, None)],
+}
+
+
+class FakeOpenstack:
+    """Generate the catalogs and serve the API requests."""
+
+    def __init__(self, config: FakeOpenstackConfig) -> None:
+        self.config = config
+        self.stats: Counter = Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(config.seed)
+
+    def count(self, resource: str) -> None:
+        with self._lock:
+            self.stats[resource] += 1
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.config.error_rate
+
+    # Keystone
+
+    def token(self, *, base: str, site: int, project: Optional[str]) -> Dict:
+        now = datetime.now(timezone.utc)
+        token = {
+            "methods": ["token"],
+            "issued_at": now.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+            "expires_at": (now + timedelta(hours=1)).strftime(
+                "%Y-%m-%dT%H:%M:%S.000000Z"
+            ),
+            "user": {
+                "id": "user",
+                "name": "user",
+                "domain": {"id": "default", "name": "Default"},
+            },
+            "roles": [{"id": "member", "name": "member"}],
+        }
+        if project is not None:
+            token["project"] = {
+                "id": project,
+                "name": project,
+                "domain": {"id": "default", "name": "Default"},
+            }
+            token["catalog"] = self.catalog(base=base, site=site, project=project)
+        return {"token": token}
+
+    def catalog(self, *, base: str, site: int, project: str) -> List[Dict]:
+        services = {
+            "identity": ("keystone", lambda r: f"{base}/site{site}/identity"),
+            "compute": (
+                "nova",
+                lambda r: f"{base}/site{site}/{region_name(r)}/compute/v2.1",
+            ),
+            "image": ("glance", lambda r: f"{base}/site{site}/{region_name(r)}/image"),
+            "network": (
+                "neutron",
+                lambda r: f"{base}/site{site}/{region_name(r)}/network",
+            ),
+            "block-storage": (
+                "cinder",
+                lambda r: f"{base}/site{site}/{region_name(r)}/volume/v3/{project}",
+            ),
+        }
+        catalog = []
+        for service_type, (name, url) in services.items():
+            endpoints = [
+                {
+                    "id": f"{service_type}-{r}",
+                    "interface": "public",
+                    "region": region_name(r),
+                    "region_id": region_name(r),
+                    "url": url(r),
+                }
+                for r in range(self.config.regions)
+            ]
+            catalog.append(
+                {
+                    "id": service_type,
+                    "type": service_type,
+                    "name": name,
+                    "endpoints": endpoints,
+                }
+            )
+        return catalog
+
+    # Nova, Glance, Neutron and Cinder
+
+    def flavors(self, site: int) -> List[Dict]:
+        n_private = int(self.config.flavors * self.config.private_flavors)
+        return [
+            {
+                "id": f"flavor-{k}",
+                "name": f"flavor-{k}",
+                "description": None,
+                "vcpus": 1 + k % 16,
+                "ram": 1024 * (1 + k % 32),
+                "disk": 10 * (1 + k % 10),
+                "OS-FLV-EXT-DATA:ephemeral": 0,
+                "swap": 0,
+                "rxtx_factor": 1.0,
+                "OS-FLV-DISABLED:disabled": False,
+                "os-flavor-access:is_public": k >= n_private,
+                "extra_specs": {"gpu_number": str(k % 2)} if k % 5 == 0 else {},
+                "links": [],
+            }
+            for k in range(self.config.flavors)
+        ]
+
+    def flavor_access(self, site: int, flavor: str) -> List[Dict]:
+        k = int(flavor.split("-")[-1])
+        return [
+            {"flavor_id": flavor, "tenant_id": project_id(site, p)}
+            for p in range(self.config.projects)
+            if (k + p) % 2 == 0
+        ]
+
+    def images(self, site: int) -> List[Dict]:
+        n_shared = int(self.config.images * self.config.shared_images)
+        return [
+            {
+                "id": f"image-{k}",
+                "name": f"image-{k}",
+                "status": "active",
+                "visibility": "shared" if k < n_shared else "public",
+                "owner": project_id(site, 0),
+                "os_type": "linux",
+                "os_distro": "ubuntu",
+                "os_version": "22.04",
+                "architecture": "x86_64",
+                "kernel_id": None,
+                "tags": [],
+                "created_at": UPDATED_AT,
+                "updated_at": UPDATED_AT,
+                "min_disk": 0,
+                "min_ram": 0,
+                "size": 1024,
+                "disk_format": "qcow2",
+                "container_format": "bare",
+                "protected": False,
+                "self": f"/v2/images/image-{k}",
+                "file": f"/v2/images/image-{k}/file",
+                "schema": "/v2/schemas/image",
+            }
+            for k in range(self.config.images)
+        ]
+
+    def image_members(self, site: int, image: str) -> List[Dict]:
+        return [
+            {
+                "image_id": image,
+                "member_id": project_id(site, p),
+                "status": "accepted",
+                "created_at": UPDATED_AT,
+                "updated_at": UPDATED_AT,
+                "schema": "/v2/schemas/member",
+            }
+            for p in range(1, self.config.projects)
+        ]
+
+    def networks(self, site: int, project: Optional[str]) -> List[Dict]:
+        return [
+            {
+                "id": f"net-{k}",
+                "name": f"net-{k}",
+                "description": "",
+                "status": "ACTIVE",
+                "shared": k % 2 == 0,
+                "router:external": k == 0,
+                "admin_state_up": True,
+                "mtu": 1500,
+                "project_id": project,
+                "tenant_id": project,
+                "revision_number": 1,
+                "tags": [],
+                "created_at": UPDATED_AT,
+                "updated_at": UPDATED_AT,
+            }
+            for k in range(self.config.networks)
+        ]
+
+
+def versions_document(*, service: str, root: str) -> Dict[str, Any]:
+    """Return the version discovery document of a service root."""
+    values = []
+    for version, min_version, max_version in VERSIONS[service]:
+        value = {
+            "id": version,
+            "status": "CURRENT",
+            "links": [{"rel": "self", "href": f"{root}/{version}/"}],
+        }
+        if min_version is not None:
+            value["min_version"] = min_version
+            value["version"] = max_version
+        values.append(value)
+    if service == "identity":
+        return {"versions": {"values": values}}
+    return {"versions": values}
+
+
+def version_document(*, service: str, url: str) -> Dict[str, Any]:
+    """Return the document describing a single version of a service."""
+    version, min_version, max_version = VERSIONS[service][0]
+    value = {
+        "id": version,
+        "status": "CURRENT",
+        "links": [{"rel": "self", "href": f"{url}/"}],
+    }
+    if min_version is not None:
+        value["min_version"] = min_version
+        value["version"] = max_version
+    return {"version": value}
+
+
+SERVICE_PATH = re.compile(
+    r"^/site(?P<site>\d+)(?:/region(?P<region>\d+))?/"
+    r"(?P<service>identity|compute|image|network|volume)(?P<rest>/.*)?$"
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: "FakeOpenstackServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def reply(
+        self,
+        status: int,
+        body: Optional[Dict] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.handle_request("POST", body)
+
+    def do_GET(self) -> None:
+        self.handle_request("GET", None)
+
+    def handle_request(self, method: str, body: Optional[Dict]) -> None:
+        fake = self.server.fake
+        path = urlsplit(self.path).path.rstrip("/")
+        if path == "/_stats":
+            self.reply(200, dict(fake.stats))
+            return
+
+        match = SERVICE_PATH.match(path)
+        if match is None:
+            self.reply(404, {"error": f"Unknown path {path}"})
+            return
+        time.sleep(fake.config.latency)
+        site = int(match.group("site"))
+        service = match.group("service")
+        rest = match.group("rest") or ""
+        root = f"{self.base_url()}{path[: len(path) - len(rest)]}"
+
+        resource, status, response, headers = self.route(
+            method=method, site=site, service=service, rest=rest, root=root, body=body
+        )
+        fake.count(resource)
+        if (
+            status == 200
+            and resource not in ("auth", "discovery")
+            and fake.should_fail()
+        ):
+            fake.count("errors")
+            self.reply(503, {"error": "Service unavailable"})
+            return
+        self.reply(status, response, headers)
+
+    def route(
+        self,
+        *,
+        method: str,
+        site: int,
+        service: str,
+        rest: str,
+        root: str,
+        body: Optional[Dict],
+    ) -> Tuple[str, int, Optional[Dict], Optional[Dict[str, str]]]:
+        fake = self.server.fake
+        parts = [i for i in rest.split("/") if i]
+        if len(parts) == 0:
+            return "discovery", 200, versions_document(service=service, root=root), None
+
+        if service == "identity":
+            if method == "POST" and parts[-1] == "auth":
+                resp = fake.token(base=self.base_url(), site=site, project=None)
+                return "auth", 201, resp, {"X-Subject-Token": uuid.uuid4().hex}
+            if method == "POST" and parts[-2:] == ["auth", "tokens"]:
+                scope = body["auth"].get("scope", {}).get("project", {})
+                resp = fake.token(base=self.base_url(), site=site, project=scope["id"])
+                return "auth", 201, resp, {"X-Subject-Token": uuid.uuid4().hex}
+            if len(parts) == 1:
+                url = f"{root}/{parts[0]}"
+                return (
+                    "discovery",
+                    200,
+                    version_document(service=service, url=url),
+                    None,
+                )
+            if parts[1] == "projects":
+                project = {
+                    "id": parts[2],
+                    "name": f"project-{parts[2][:8]}",
+                    "description": None,
+                    "domain_id": "default",
+                    "enabled": True,
+                    "is_domain": False,
+                    "parent_id": "default",
+                    "tags": [],
+                }
+                return "project", 200, {"project": project}, None
+
+        if service == "compute":
+            if len(parts) == 1:
+                url = f"{root}/{parts[0]}"
+                return (
+                    "discovery",
+                    200,
+                    version_document(service=service, url=url),
+                    None,
+                )
+            if parts[1:] == ["flavors", "detail"]:
+                return "flavors", 200, {"flavors": fake.flavors(site)}, None
+            if parts[1] == "flavors" and parts[-1] == "os-flavor-access":
+                access = fake.flavor_access(site, parts[2])
+                return "flavor_access", 200, {"flavor_access": access}, None
+            if parts[1] == "os-quota-sets":
+                quota = {"id": parts[2], "cores": 20, "instances": 10, "ram": 51200}
+                return "compute_quotas", 200, {"quota_set": quota}, None
+
+        if service == "image":
+            if len(parts) == 1:
+                url = f"{root}/{parts[0]}"
+                return (
+                    "discovery",
+                    200,
+                    version_document(service=service, url=url),
+                    None,
+                )
+            if parts[1:] == ["images"]:
+                return "images", 200, {"images": fake.images(site)}, None
+            if parts[1] == "images" and parts[-1] == "members":
+                members = fake.image_members(site, parts[2])
+                return "image_members", 200, {"members": members}, None
+
+        if service == "network":
+            if len(parts) == 1:
+                url = f"{root}/{parts[0]}"
+                return (
+                    "discovery",
+                    200,
+                    version_document(service=service, url=url),
+                    None,
+                )
+            if parts[1:] == ["networks"]:
+                return "networks", 200, {"networks": fake.networks(site, None)}, None
+            if parts[1] == "quotas":
+                quota = {"floatingip": 10, "network": 5, "port": 50}
+                return "network_quotas", 200, {"quota": quota}, None
+
+        if service == "volume":
+            if len(parts) <= 2 and parts[0] == "v3":
+                url = f"{root}/{'/'.join(parts)}"
+                return (
+                    "discovery",
+                    200,
+                    version_document(service=service, url=url),
+                    None,
+                )
+            if parts[2] == "os-quota-sets":
+                quota = {"id": parts[3], "gigabytes": 1000, "volumes": 10}
+                return "block_storage_quotas", 200, {"quota_set": quota}, None
+
+        return "unknown", 404, {"error": f"Unknown path {rest}"}, None
+
+
+class FakeOpenstackServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], fake: FakeOpenstack) -> None:
+        super().__init__(address, Handler)
+        self.fake = fake
+
+
+def serve(config: FakeOpenstackConfig, port_queue: Any) -> None:
+    """Serve forever on a random local port, sending the port to the queue."""
+    server = FakeOpenstackServer(("127.0.0.1", 0), FakeOpenstack(config))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
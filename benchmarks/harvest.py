@@ -0,0 +1,171 @@
+"""Benchmark the harvest pipeline against a local fake OpenStack.
+
+Start the fake Keystone, Nova, Glance, Neutron and Cinder endpoints in a
+separate process, generate the configuration of N providers x R regions x P
+projects and run the real harvest on them. Report wall time, API calls per
+resource and peak RSS of the harvesting process.
+
+Usage:
+    python benchmarks/harvest.py --providers 10 --regions 2 --projects 5 \
+        --latency-ms 20
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List
+from urllib.request import urlopen
+
+import yaml
+from fake_openstack import (
+    NAMESPACE,
+    FakeOpenstackConfig,
+    project_id,
+    region_name,
+    serve,
+)
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+ISSUER = "https://idp.bench.local/"
+
+
+def sla_id(site: int, project: int) -> str:
+    """Return the deterministic SLA document ID of a project."""
+    return uuid.uuid5(NAMESPACE, f"site{site}-sla{project}").hex
+
+
+def write_configs(*, path: str, port: int, args: argparse.Namespace) -> List[str]:
+    """Write one provider configuration file per site and return their paths."""
+    fnames = []
+    for site in range(args.providers):
+        config = {
+            "trusted_idps": [
+                {
+                    "issuer": ISSUER,
+                    "group_claim": "groups",
+                    "token": "bench-token",
+                    "user_groups": [
+                        {
+                            "name": f"group{project}",
+                            "slas": [
+                                {
+                                    "doc_uuid": sla_id(site, project),
+                                    "start_date": "2023-01-01",
+                                    "end_date": "2099-12-31",
+                                }
+                            ],
+                        }
+                        for project in range(args.projects)
+                    ],
+                }
+            ],
+            "openstack": [
+                {
+                    "name": f"bench-provider{site}",
+                    "status": "active",
+                    "is_public": False,
+                    "support_emails": ["admin@bench.local"],
+                    "auth_url": f"http://127.0.0.1:{port}/site{site}/identity",
+                    "identity_providers": [
+                        {"endpoint": ISSUER, "name": "bench-idp", "protocol": "openid"}
+                    ],
+                    "regions": [
+                        {"name": region_name(region)} for region in range(args.regions)
+                    ],
+                    "projects": [
+                        {"id": project_id(site, project), "sla": sla_id(site, project)}
+                        for project in range(args.projects)
+                    ],
+                }
+            ],
+        }
+        fname = os.path.join(path, f"bench-provider{site}.config.yaml")
+        with open(fname, "w") as f:
+            yaml.safe_dump(config, f)
+        fnames.append(fname)
+    return fnames
+
+
+def get_stats(port: int) -> Dict[str, int]:
+    """Return the API calls counted by the fake OpenStack."""
+    with urlopen(f"http://127.0.0.1:{port}/_stats") as resp:
+        return json.load(resp)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--providers", type=int, default=1)
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--projects", type=int, default=1)
+    parser.add_argument("--flavors", type=int, default=20)
+    parser.add_argument("--private-flavors", type=float, default=0.5)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--shared-images", type=float, default=0.2)
+    parser.add_argument("--networks", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--runs", type=int, default=1, help="Consecutive harvests")
+    parser.add_argument(
+        "--cache-dir", default=None, help="Harvest cache to use (default: empty)"
+    )
+    args = parser.parse_args(argv)
+
+    fake_config = FakeOpenstackConfig(
+        sites=args.providers,
+        regions=args.regions,
+        projects=args.projects,
+        flavors=args.flavors,
+        private_flavors=args.private_flavors,
+        images=args.images,
+        shared_images=args.shared_images,
+        networks=args.networks,
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+    )
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve, args=(fake_config, port_queue), daemon=True
+    )
+    server.start()
+    port = port_queue.get(timeout=10)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Settings are read once: configure them before importing the script.
+        os.environ["HARVEST_CACHE_DIR"] = args.cache_dir or os.path.join(tmp, "cache")
+        os.environ["STATE_FILE"] = os.path.join(tmp, "state.json")
+        sys.path.insert(0, SRC_DIR)
+        from main import harvest
+        from utils import load_config
+
+        fnames = write_configs(path=tmp, port=port, args=args)
+        configs = [load_config(fname=fname) for fname in fnames]
+
+        for run in range(args.runs):
+            before = get_stats(port)
+            start = time.perf_counter()
+            providers = asyncio.run(harvest(configs=configs))
+            wall_time = time.perf_counter() - start
+            stats = get_stats(port)
+            calls = {k: v - before.get(k, 0) for k, v in stats.items()}
+
+            print(f"Run {run + 1}/{args.runs}")
+            print(f"  Providers harvested: {len(providers)}/{args.providers}")
+            print(f"  Wall time: {wall_time:.2f} s")
+            print(f"  API calls: {sum(calls.values())}")
+            for k, v in sorted(calls.items()):
+                print(f"    {k:<22}{v:>8}")
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Peak RSS: {peak_rss:.1f} MiB")
+    server.terminate()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,72 @@
+"""Check the cold start import time of an entry point against a budget.
+
+The module is imported in a fresh interpreter with `-X importtime`, several
+times, and the best cumulative time is compared with the budget. Exit with a
+non-zero status when the budget is exceeded.
+
+Usage:
+    python benchmarks/importtime.py --module main --budget-ms 300
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def measure(*, module: str) -> Tuple[int, Dict[str, int]]:
+    """Import module in a new interpreter.
+
+    Return the cumulative import time (us) and the self time of each module.
+    """
+    env = {**os.environ, "PYTHONPATH": SRC_DIR}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR,
+        env=env,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    total = 0
+    self_times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        self_times[name.strip()] = int(self_us)
+        if name.strip() == module:
+            total = int(cumulative_us)
+    return total, self_times
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument(
+        "--budget-ms", type=float, default=300, help="Maximum import time (ms)"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs")
+    parser.add_argument("--top", type=int, default=10, help="Slowest modules shown")
+    args = parser.parse_args(argv)
+
+    runs = [measure(module=args.module) for _ in range(args.repeat)]
+    total, self_times = min(runs, key=lambda x: x[0])
+    total_ms = total / 1000
+
+    print(f"Slowest modules imported by '{args.module}':")
+    for name, us in sorted(self_times.items(), key=lambda x: -x[1])[: args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    print(f"Import time of '{args.module}': {total_ms:.1f} ms")
+    print(f"Budget: {args.budget_ms:.1f} ms")
+
+    if total_ms > args.budget_ms:
+        print("Import time budget exceeded")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,157 @@
+from functools import lru_cache
+from typing import Literal, Optional
+
+from pydantic import BaseSettings, Field, root_validator
+
+
+class Settings(BaseSettings):
+    """Script settings, read from environment variables."""
+
+    MAX_WORKERS: int = Field(
+        default=32, description="Maximum number of concurrent calls in a run"
+    )
+    MAX_WORKERS_PER_SITE: int = Field(
+        default=4,
+        description="Maximum number of concurrent calls targeting the same auth_url",
+    )
+    PROVIDER_DEADLINE: float = Field(
+        default=900, description="Time budget (s) to harvest a provider"
+    )
+    PROJECT_DEADLINE: float = Field(
+        default=300,
+        description="Time budget (s) to harvest a project in a region",
+    )
+    MAX_RETRIES: int = Field(
+        default=2,
+        ge=0,
+        description="Retries of OpenStack reads failing with a transient error",
+    )
+    RETRY_BACKOFF: float = Field(
+        default=0.5,
+        description="Base delay (s) of the jittered exponential backoff between "
+        "retries",
+    )
+    CIRCUIT_BREAKER_THRESHOLD: int = Field(
+        default=5,
+        gt=0,
+        description="Consecutive transient failures after which calls to a site "
+        "fail fast",
+    )
+    CIRCUIT_BREAKER_RESET: float = Field(
+        default=60,
+        description="Seconds after which calls to a failing site are tried again",
+    )
+    HEDGE_PERCENTILE: Optional[float] = Field(
+        default=0.95,
+        gt=0,
+        le=1,
+        description="Latency percentile of a site after which idempotent reads are "
+        "sent a second time. Unset to disable hedging",
+    )
+    REGISTRY_POOL_SIZE: int = Field(
+        default=10,
+        description="Number of keep-alive connections to the Federation Registry",
+    )
+    REGISTRY_CONNECT_TIMEOUT: float = Field(
+        default=5, description="Federation Registry connect timeout (s)"
+    )
+    REGISTRY_READ_TIMEOUT: float = Field(
+        default=30, description="Federation Registry read timeout (s)"
+    )
+    REGISTRY_MAX_IN_FLIGHT: int = Field(
+        default=8,
+        description="Maximum number of concurrent write requests to the Federation "
+        "Registry",
+    )
+    REGISTRY_PAGE_SIZE: int = Field(
+        default=100,
+        gt=0,
+        description="Number of items per page when listing the Federation Registry",
+    )
+    REGISTRY_COMPRESSION: bool = Field(
+        default=True,
+        description="Accept compressed responses from the Federation Registry",
+    )
+    REGISTRY_REQUEST_COMPRESSION: Optional[Literal["gzip", "zstd"]] = Field(
+        default=None,
+        description="Compress request bodies sent to the Federation Registry. "
+        "Requests are sent uncompressed if the Federation Registry rejects them",
+    )
+    REGISTRY_SYNC_MODE: Literal["provider", "resources"] = Field(
+        default="provider",
+        description="Update changed providers as a whole, or update and remove "
+        "only their changed flavors, images, networks and quotas through their own "
+        "endpoints when possible",
+    )
+    HARVEST_CACHE_DIR: str = Field(
+        default=".harvest-cache",
+        description="Directory storing the snapshots of the harvested resources",
+    )
+    HARVEST_CACHE_FULL_REFRESH: float = Field(
+        default=3600,
+        description="Interval (s) after which resources are listed from scratch",
+    )
+    CONFIG_CACHE_DIR: str = Field(
+        default=".config-cache",
+        description="Directory storing the validated provider configurations. "
+        "Empty to disable",
+    )
+    TOKEN_REFRESH_MARGIN: float = Field(
+        default=60,
+        description="Seconds before expiration when generated tokens are renewed",
+    )
+    TOKEN_DEFAULT_LIFETIME: float = Field(
+        default=300,
+        description="Lifetime (s) assumed for generated tokens which are not JWTs",
+    )
+    STATE_FILE: str = Field(
+        default=".federation-registry-state.json",
+        description="File storing the fingerprints of the last pushed providers",
+    )
+    METRICS_FILE: str = Field(
+        default="",
+        description="Prometheus textfile where run metrics are written. Empty to "
+        "disable",
+    )
+    METRICS_PORT: Optional[int] = Field(
+        default=None, description="Port exposing the daemon metrics over HTTP"
+    )
+    PROFILE_DIR: str = Field(
+        default=".profiles",
+        description="Directory storing the CPU and allocation profiles of the runs "
+        "started with --profile",
+    )
+    PROFILE_KEEP: int = Field(
+        default=10, gt=0, description="Number of profiled runs to keep"
+    )
+    SHARD_COUNT: int = Field(
+        default=1, gt=0, description="Number of replicas sharing the providers"
+    )
+    SHARD_INDEX: int = Field(
+        default=0,
+        ge=0,
+        description="Index of this replica. It harvests, updates and removes only "
+        "the providers whose name hashes to it",
+    )
+    DAEMON_REFRESH_INTERVAL: float = Field(
+        default=300,
+        description="Default seconds between two harvests of the same provider",
+    )
+    DAEMON_POLL_INTERVAL: float = Field(
+        default=10,
+        description="Seconds between two checks of the configuration files",
+    )
+
+    @root_validator
+    def shard_index_lower_than_count(cls, values):
+        count = values.get("SHARD_COUNT")
+        index = values.get("SHARD_INDEX")
+        if count is not None and index is not None:
+            assert index < count, f"Shard index {index} not lower than count {count}"
+        return values
+
+
+@lru_cache
+def get_settings() -> Settings:
+    """Return the cached settings instance."""
+    return Settings()
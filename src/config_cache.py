@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from importlib.metadata import PackageNotFoundError, version
+from typing import NamedTuple, Optional
+
+import app
+import pydantic
+from logger import logger
+from models import provider
+from models.provider import SiteConfig
+
+
+def get_schemas_digest() -> str:
+    """Return a hash of the Federation Registry schemas the models build on.
+
+    The installed package version does not change when it is installed from a
+    git revision.
+    """
+    digest = hashlib.sha256()
+    for root in app.__path__:
+        for path, dirs, files in os.walk(root):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname.startswith(("schemas", "enum")) and fname.endswith(".py"):
+                    fname = os.path.join(path, fname)
+                    digest.update(os.path.relpath(fname, root).encode())
+                    with open(fname, "rb") as f:
+                        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_models_version() -> str:
+    """Return a marker changing whenever the configuration models may change."""
+    try:
+        registry_version = version("federation-registry")
+    except PackageNotFoundError:
+        registry_version = ""
+    with open(provider.__file__, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    return f"{digest}-{get_schemas_digest()}-{pydantic.VERSION}-{registry_version}"
+
+
+class CachedConfig(NamedTuple):
+    models_version: str
+    mtime: float
+    digest: str
+    config: SiteConfig
+
+
+class ConfigCache:
+    """On disk cache of validated site configurations, keyed by file path.
+
+    An entry is valid while the file mtime and content hash, and the models, are
+    unchanged.
+    """
+
+    def __init__(self, *, path: str) -> None:
+        self.path = path
+        self.models_version = get_models_version()
+        os.makedirs(path, exist_ok=True)
+
+    def _fname(self, fname: str) -> str:
+        digest = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()
+        return os.path.join(self.path, f"{digest}.pickle")
+
+    def load(self, fname: str, *, mtime: float, digest: str) -> Optional[SiteConfig]:
+        """Return the cached configuration or None if missing or outdated."""
+        cache_fname = self._fname(fname)
+        if not os.path.isfile(cache_fname):
+            return None
+        try:
+            with open(cache_fname, "rb") as f:
+                cached: CachedConfig = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring corrupted config cache {cache_fname}: {e!r}")
+            return None
+        if (cached.models_version, cached.mtime, cached.digest) != (
+            self.models_version,
+            mtime,
+            digest,
+        ):
+            return None
+        return cached.config
+
+    def store(
+        self, fname: str, *, mtime: float, digest: str, config: SiteConfig
+    ) -> None:
+        """Atomically write the configuration on disk.
+
+        Concurrent runs write through distinct temporary files.
+        """
+        cached = CachedConfig(
+            models_version=self.models_version,
+            mtime=mtime,
+            digest=digest,
+            config=config,
+        )
+        # The configuration may hold access tokens: temporary files are private.
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=self.path, prefix=".config.", delete=False
+        ) as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self._fname(fname))
@@ -1,14 +1,76 @@
 import os
-from typing import Any, Dict, List, Optional
+from http import HTTPStatus
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set, Union
+from urllib.parse import urlparse
+from uuid import UUID
 
 import requests
+from app.provider.schemas import ProviderBase
 from app.provider.schemas_extended import ProviderCreateExtended, ProviderReadExtended
-from fastapi import status
-from fastapi.encoders import jsonable_encoder
+from config import Settings, get_settings
 from logger import logger
-from pydantic import AnyHttpUrl
+from metrics import metrics
+from pydantic import AnyHttpUrl, BaseModel
+from requests.adapters import HTTPAdapter
+from serialization import compress, dumps, get_content_encoding, loads
+from state import compute_digest
 
-TIMEOUT = 5  # s
+# Statuses of a registry unable to decode a compressed body: FastAPI answers 400
+# or 422 when it does not support the content encoding at all.
+COMPRESSION_REJECTED = (
+    HTTPStatus.BAD_REQUEST,
+    HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+    HTTPStatus.UNPROCESSABLE_ENTITY,
+)
+
+# Hosts of the registries which rejected compressed bodies during this process.
+uncompressed_hosts: Set[str] = set()
+
+# Provider attributes returned by every listing, short ones included.
+BASE_FIELDS = tuple(f.alias for f in ProviderBase.__fields__.values())
+
+
+def compute_record_fingerprint(data: Dict[str, Any]) -> str:
+    """Return a hash of the base attributes of a JSON encoded provider."""
+    return compute_digest({k: data.get(k) for k in BASE_FIELDS})
+
+
+def create_session(*, settings: Settings) -> requests.Session:
+    """Create an HTTP session keeping a pool of connections alive."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.REGISTRY_POOL_SIZE,
+        pool_maxsize=settings.REGISTRY_POOL_SIZE,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["accept-encoding"] = (
+        "gzip, deflate" if settings.REGISTRY_COMPRESSION else "identity"
+    )
+    return session
+
+
+class RegistryItem(NamedTuple):
+    """Registry item index record.
+
+    The fingerprint of the base attributes detects changes made in the registry
+    without reading the full record.
+    """
+
+    name: str
+    uid: str
+    fingerprint: str
+    data: Dict[str, Any]
+
+    @classmethod
+    def from_record(cls, data: Dict[str, Any]) -> "RegistryItem":
+        """Index a provider record read from the registry."""
+        return cls(
+            name=data["name"],
+            uid=str(UUID(data["uid"])),
+            fingerprint=compute_record_fingerprint(data),
+            data=data,
+        )
 
 
 class CRUD:
@@ -18,33 +80,185 @@ class CRUD:
         url: AnyHttpUrl,
         read_headers: Dict[str, str],
         write_headers: Dict[str, str],
+        session: Optional[requests.Session] = None,
     ) -> None:
+        settings = get_settings()
         self.type = "Provider"
         self.read_headers = read_headers
         self.write_headers = write_headers
         self.list_url = url
         self.item_url = os.path.join(url, "{uid}")
+        self.timeout = (
+            settings.REGISTRY_CONNECT_TIMEOUT,
+            settings.REGISTRY_READ_TIMEOUT,
+        )
+        self.host = urlparse(url).netloc
+        self.content_encoding = (
+            None
+            if self.host in uncompressed_hosts
+            else get_content_encoding(settings.REGISTRY_REQUEST_COMPRESSION)
+        )
+        self._own_session = session is None
+        self.session = create_session(settings=settings) if session is None else session
 
-    def read(self, *, with_conn: bool = False) -> List[ProviderReadExtended]:
-        """Retrieve all instances of this type."""
-        logger.info(f"Looking for all {self.type}s")
-        logger.debug(f"Url={self.list_url}")
+    def __enter__(self) -> "CRUD":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the pooled connections, unless the session was given."""
+        if self._own_session:
+            self.session.close()
 
-        resp = requests.get(
+    def _write(
+        self,
+        method: str,
+        *,
+        url: str,
+        data: Union[BaseModel, Dict[str, Any]],
+        params: Optional[Dict[str, Any]] = None,
+    ) -> requests.Response:
+        """Send the data encoded as JSON, compressed if the registry accepts it.
+
+        When the registry rejects the compressed body, send it again uncompressed.
+        If the uncompressed body is accepted, stop compressing the following
+        requests to that registry.
+        """
+        body = dumps(data)
+        if self.content_encoding is not None:
+            resp = self.session.request(
+                method,
+                url=url,
+                data=compress(body, encoding=self.content_encoding),
+                headers={
+                    **self.write_headers,
+                    "content-encoding": self.content_encoding,
+                },
+                params=params,
+                timeout=self.timeout,
+            )
+            if resp.status_code not in COMPRESSION_REJECTED:
+                return resp
+        uncompressed_resp = self.session.request(
+            method,
+            url=url,
+            data=body,
+            headers=self.write_headers,
+            params=params,
+            timeout=self.timeout,
+        )
+        if self.content_encoding is not None and (
+            uncompressed_resp.status_code < HTTPStatus.BAD_REQUEST
+            or resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+        ):
+            logger.warning(
+                f"Federation Registry rejected {self.content_encoding} encoded "
+                "data. Sending uncompressed requests"
+            )
+            uncompressed_hosts.add(self.host)
+            self.content_encoding = None
+        return uncompressed_resp
+
+    def _observe(
+        self, phase: str, resp: requests.Response, *, provider: str = ""
+    ) -> None:
+        """Record the duration, the outcome and the bytes of a request."""
+        metrics.observe(
+            phase,
+            resp.elapsed.total_seconds(),
+            failed=resp.status_code >= HTTPStatus.BAD_REQUEST,
+            provider=provider,
+        )
+        sent = len(resp.request.body or b"")
+        metrics.add_bytes(phase, sent + len(resp.content), provider=provider)
+
+    def _read_page(self, params: Dict[str, Any]) -> List[RegistryItem]:
+        resp = self.session.get(
             url=self.list_url,
-            params={"with_conn": with_conn},
+            params=params,
             headers=self.read_headers,
-            timeout=TIMEOUT,
+            timeout=self.timeout,
         )
-        if resp.status_code == status.HTTP_200_OK:
-            logger.debug(f"{resp.json()}")
-            return [ProviderReadExtended(**i) for i in resp.json()]
+        self._observe("registry_read", resp)
+        if resp.status_code == HTTPStatus.OK:
+            items = [RegistryItem.from_record(i) for i in loads(resp.content)]
+            metrics.add_items("registry_read", len(items))
+            logger.debug(f"Retrieved {len(items)} {self.type}s")
+            return items
 
         logger.error("GET operation failed")
         logger.error(f"Status code: {resp.status_code}")
         logger.error(f"Message: {resp.text}")
         raise Exception("GET operation failed")
 
+    def read(
+        self,
+        *,
+        with_conn: bool = False,
+        short: bool = False,
+        page_size: Optional[int] = None,
+    ) -> Iterator[RegistryItem]:
+        """Retrieve all instances of this type.
+
+        When page_size is given, items are retrieved and yielded one page at a
+        time, sorted by uid so that pages do not depend on the registry storage
+        order. When short is True, only their identifiers and base attributes are
+        retrieved: use read_one to get the full record of an item.
+
+        Raise when an item appears in two pages: items were added or removed
+        during the read, so some of them may have been skipped.
+        """
+        logger.info(f"Looking for all {self.type}s")
+        logger.debug(f"Url={self.list_url}")
+
+        params: Dict[str, Any] = {"with_conn": with_conn, "short": short}
+        if page_size is not None:
+            params["sort"] = "uid"
+        first_page: List[str] = []
+        seen: Set[str] = set()
+        page = 0
+        while True:
+            if page_size is not None:
+                params.update(page=page, size=page_size)
+            items = self._read_page(params)
+            uids = [i.uid for i in items]
+            # The registry ignores pagination: the first page was the whole list.
+            if page_size is not None and page > 0 and uids == first_page:
+                return
+            duplicates = [i.name for i in items if i.uid in seen]
+            if len(duplicates) > 0:
+                logger.error(f"{self.type}s listed in two pages: {duplicates}")
+                raise Exception(f"{self.type}s changed while reading them")
+            yield from items
+            if page_size is None or len(items) < page_size:
+                return
+            if page == 0:
+                first_page = uids
+            seen.update(uids)
+            page += 1
+
+    def read_one(self, *, uid: str, with_conn: bool = True) -> RegistryItem:
+        """Retrieve the full record of an instance."""
+        logger.info(f"Looking for {self.type} with uid={uid}")
+        logger.debug(f"Url={self.item_url.format(uid=uid)}")
+
+        resp = self.session.get(
+            url=self.item_url.format(uid=uid),
+            params={"with_conn": with_conn},
+            headers=self.read_headers,
+            timeout=self.timeout,
+        )
+        self._observe("registry_read", resp)
+        if resp.status_code == HTTPStatus.OK:
+            return RegistryItem.from_record(loads(resp.content))
+
+        logger.error(f"Failed to read {self.type} with uid={uid}")
+        logger.error(f"Status code: {resp.status_code}")
+        logger.error(f"Message: {resp.text}")
+        raise Exception(f"Failed to read {self.type} with uid={uid}")
+
     def create(
         self,
         *,
@@ -56,14 +270,9 @@ class CRUD:
         logger.debug(f"Url={self.list_url}")
         logger.debug(f"New Data={data}")
 
-        resp = requests.post(
-            url=self.list_url,
-            json=jsonable_encoder(data),
-            headers=self.write_headers,
-            params=params,
-            timeout=TIMEOUT,
-        )
-        if resp.status_code == status.HTTP_201_CREATED:
+        resp = self._write("POST", url=self.list_url, data=data, params=params)
+        self._observe("registry_create", resp, provider=data.name)
+        if resp.status_code == HTTPStatus.CREATED:
             logger.info("Created")
             logger.debug(f"{resp.json()}")
             return ProviderReadExtended(**resp.json())
@@ -73,17 +282,18 @@ class CRUD:
         logger.error(f"Message: {resp.text}")
         raise Exception(f"Failed to create {self.type}={data.name}")
 
-    def remove(self, *, item: ProviderReadExtended) -> None:
+    def remove(self, *, item: RegistryItem) -> None:
         """Remove item."""
         logger.info(f"Removing {self.type}={item.name}.")
         logger.debug(f"Url={self.item_url.format(uid=item.uid)}")
 
-        resp = requests.delete(
+        resp = self.session.delete(
             url=self.item_url.format(uid=item.uid),
             headers=self.write_headers,
-            timeout=TIMEOUT,
+            timeout=self.timeout,
         )
-        if resp.status_code == status.HTTP_204_NO_CONTENT:
+        self._observe("registry_remove", resp, provider=item.name)
+        if resp.status_code == HTTPStatus.NO_CONTENT:
             logger.info("Removed")
             return None
 
@@ -93,25 +303,23 @@ class CRUD:
         raise Exception(f"Failed to remove {self.type}={item.name}")
 
     def update(
-        self, *, new_data: ProviderCreateExtended, old_data: ProviderReadExtended
+        self, *, new_data: ProviderCreateExtended, old_data: RegistryItem
     ) -> Optional[ProviderReadExtended]:
         """Update existing instance."""
         logger.info(f"Updating {self.type}={new_data.name}.")
         logger.debug(f"Url={self.item_url.format(uid=old_data.uid)}")
         logger.debug(f"New Data={new_data}")
 
-        resp = requests.put(
-            url=self.item_url.format(uid=old_data.uid),
-            json=jsonable_encoder(new_data),
-            headers=self.write_headers,
-            timeout=TIMEOUT,
+        resp = self._write(
+            "PUT", url=self.item_url.format(uid=old_data.uid), data=new_data
         )
-        if resp.status_code == status.HTTP_200_OK:
+        self._observe("registry_update", resp, provider=new_data.name)
+        if resp.status_code == HTTPStatus.OK:
             logger.info(f"{self.type}={new_data.name} successfully updated")
             logger.debug(f"{resp.json()}")
             return ProviderReadExtended(**resp.json())
 
-        if resp.status_code == status.HTTP_304_NOT_MODIFIED:
+        if resp.status_code == HTTPStatus.NOT_MODIFIED:
             logger.info(
                 f"New data match stored data. {self.type}={new_data.name} not modified"
             )
@@ -121,3 +329,54 @@ class CRUD:
         logger.error(f"Status code: {resp.status_code}")
         logger.error(f"Message: {resp.text}")
         raise Exception(f"Failed to update {self.type}={new_data.name}")
+
+
+class ResourceCRUD(CRUD):
+    """Update or remove single sub-resources of a provider through their own
+    endpoint.
+    """
+
+    def __init__(self, *, type: str, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.type = type
+
+    def update_one(self, *, uid: str, name: str, data: Dict[str, Any]) -> None:
+        """Update existing instance."""
+        logger.info(f"Updating {self.type}={name}.")
+        logger.debug(f"Url={self.item_url.format(uid=uid)}")
+        logger.debug(f"New Data={data}")
+
+        resp = self._write("PUT", url=self.item_url.format(uid=uid), data=data)
+        self._observe("registry_update_resource", resp)
+        if resp.status_code == HTTPStatus.OK:
+            logger.info(f"{self.type}={name} successfully updated")
+            return None
+
+        if resp.status_code == HTTPStatus.NOT_MODIFIED:
+            logger.info(f"New data match stored data. {self.type}={name} not modified")
+            return None
+
+        logger.error(f"Failed to update {self.type}={name}")
+        logger.error(f"Status code: {resp.status_code}")
+        logger.error(f"Message: {resp.text}")
+        raise Exception(f"Failed to update {self.type}={name}")
+
+    def remove_one(self, *, uid: str, name: str) -> None:
+        """Remove instance."""
+        logger.info(f"Removing {self.type}={name}.")
+        logger.debug(f"Url={self.item_url.format(uid=uid)}")
+
+        resp = self.session.delete(
+            url=self.item_url.format(uid=uid),
+            headers=self.write_headers,
+            timeout=self.timeout,
+        )
+        self._observe("registry_remove_resource", resp)
+        if resp.status_code == HTTPStatus.NO_CONTENT:
+            logger.info("Removed")
+            return None
+
+        logger.error(f"Failed to remove {self.type}={name}")
+        logger.error(f"Status code: {resp.status_code}")
+        logger.error(f"Message: {resp.text}")
+        raise Exception(f"Failed to remove {self.type}={name}")
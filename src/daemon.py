@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import os
+import time
+from functools import partial
+from typing import Dict, List, NamedTuple, Tuple
+
+from config import get_settings
+from logger import logger
+from metrics import metrics
+from models.provider import Openstack, SiteConfig
+from providers.cache import HarvestCache
+from providers.opnstk import TIMEOUT, get_provider
+from providers.sessions import SessionCache
+from scheduler import Scheduler
+from state import StateStore
+from utils import (
+    SyncResult,
+    get_config_cache,
+    get_failures_summary,
+    get_token_provider,
+    is_owned,
+    list_config_files,
+    load_config,
+    load_federation_registry_config,
+    update_database,
+)
+
+
+def raise_on_failures(results: List[SyncResult]) -> None:
+    """Raise if any Federation Registry operation failed."""
+    failures_summary = get_failures_summary(results)
+    if failures_summary is not None:
+        raise Exception(failures_summary)
+
+
+class LoadedConfig(NamedTuple):
+    mtime: float
+    config: SiteConfig
+
+
+class Daemon:
+    """Resident process refreshing each provider on its own interval.
+
+    Modules, keystone sessions and harvest caches stay warm between cycles.
+    Configuration files are reloaded when they change on disk. A provider cycle
+    never starts while the previous cycle of the same provider is still running.
+    """
+
+    def __init__(self, *, base_path: str = ".") -> None:
+        self.base_path = base_path
+        self.settings = get_settings()
+        self.federation_registry_urls = load_federation_registry_config(
+            base_path=base_path
+        )
+        self.config_cache = get_config_cache()
+        self.token_provider = get_token_provider()
+        # Shared by the concurrent syncs of all providers.
+        self.state = StateStore(path=self.settings.STATE_FILE)
+        self.configs: Dict[str, LoadedConfig] = {}
+        self.next_runs: Dict[str, float] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        # Providers removed from the configuration while the daemon was down
+        # are removed from the Federation Registry at startup.
+        self.pending_removal = True
+
+    def load_configs(self) -> Dict[str, LoadedConfig]:
+        """Return the configurations, reloading the changed ones."""
+        configs = {}
+        for fname in list_config_files(base_path=self.base_path):
+            mtime = os.path.getmtime(fname)
+            loaded = self.configs.get(fname)
+            if loaded is not None and loaded.mtime == mtime:
+                configs[fname] = loaded
+                continue
+            try:
+                config = load_config(fname=fname, cache=self.config_cache)
+            except Exception as e:
+                logger.error(f"Failed to load {fname}: {e!r}")
+                if loaded is not None:
+                    configs[fname] = loaded
+                continue
+            configs[fname] = LoadedConfig(mtime=mtime, config=config)
+        return configs
+
+    def get_os_confs(self) -> Dict[str, Tuple[Openstack, SiteConfig]]:
+        """Return the configured openstack providers owned by this replica and
+        their site configuration.
+        """
+        return {
+            os_conf.name: (os_conf, loaded.config)
+            for loaded in self.configs.values()
+            for os_conf in loaded.config.openstack
+            if is_owned(os_conf.name)
+        }
+
+    async def cycle(
+        self,
+        *,
+        os_conf: Openstack,
+        config: SiteConfig,
+        scheduler: Scheduler,
+        session_cache: SessionCache,
+        harvest_cache: HarvestCache,
+    ) -> None:
+        """Harvest a provider and push it to the Federation Registry."""
+        logger.info(f"Starting cycle of provider={os_conf.name}")
+        loop = asyncio.get_running_loop()
+        try:
+            # Renew generated tokens close to expiration.
+            await loop.run_in_executor(None, self.token_provider.fill, [config])
+            provider = await get_provider(
+                os_conf=os_conf,
+                site_config=config,
+                scheduler=scheduler,
+                session_cache=session_cache,
+                harvest_cache=harvest_cache,
+            )
+            results = await loop.run_in_executor(
+                None,
+                partial(
+                    update_database,
+                    federation_registry_urls=self.federation_registry_urls,
+                    items=[provider],
+                    token=config.trusted_idps[0].token,
+                    remove_missing=False,
+                    state=self.state,
+                ),
+            )
+            raise_on_failures(results)
+        except Exception as e:
+            logger.error(f"Cycle of provider={os_conf.name} failed: {e!r}")
+        logger.info(f"Cycle of provider={os_conf.name} completed")
+
+    async def reconcile(
+        self, os_confs: Dict[str, Tuple[Openstack, SiteConfig]]
+    ) -> None:
+        """Remove from the Federation Registry the providers no more configured.
+
+        Configured providers are only pushed by their own cycle: an older harvest
+        never overwrites a newer one.
+        """
+        logger.info("Removing providers no more configured")
+        self.pending_removal = False
+        loop = asyncio.get_running_loop()
+        config = next(iter(os_confs.values()))[1]
+        try:
+            await loop.run_in_executor(None, self.token_provider.fill, [config])
+            results = await loop.run_in_executor(
+                None,
+                partial(
+                    update_database,
+                    federation_registry_urls=self.federation_registry_urls,
+                    items=[],
+                    token=config.trusted_idps[0].token,
+                    remove_missing=True,
+                    protected=list(os_confs),
+                    state=self.state,
+                ),
+            )
+            raise_on_failures(results)
+        except Exception as e:
+            logger.error(f"Failed to remove old providers: {e!r}")
+            self.pending_removal = True
+
+    async def run(self) -> None:
+        """Schedule provider cycles forever."""
+        scheduler = Scheduler(
+            max_workers=self.settings.MAX_WORKERS,
+            max_workers_per_site=self.settings.MAX_WORKERS_PER_SITE,
+            max_retries=self.settings.MAX_RETRIES,
+            backoff=self.settings.RETRY_BACKOFF,
+            breaker_threshold=self.settings.CIRCUIT_BREAKER_THRESHOLD,
+            breaker_reset_timeout=self.settings.CIRCUIT_BREAKER_RESET,
+            hedge_percentile=self.settings.HEDGE_PERCENTILE,
+        )
+        session_cache = SessionCache(timeout=TIMEOUT)
+        harvest_cache = HarvestCache(
+            path=self.settings.HARVEST_CACHE_DIR,
+            full_refresh_interval=self.settings.HARVEST_CACHE_FULL_REFRESH,
+        )
+        loop = asyncio.get_running_loop()
+        if self.settings.METRICS_PORT is not None:
+            metrics.serve(self.settings.METRICS_PORT)
+
+        while True:
+            self.configs = await loop.run_in_executor(None, self.load_configs)
+            os_confs = self.get_os_confs()
+            for name in set(self.next_runs) - set(os_confs):
+                self.next_runs.pop(name)
+                self.pending_removal = True
+
+            now = time.time()
+            for name, (os_conf, config) in os_confs.items():
+                task = self.running.get(name)
+                if task is not None and not task.done():
+                    continue
+                if self.next_runs.get(name, 0) > now:
+                    continue
+                interval = (
+                    os_conf.refresh_interval or self.settings.DAEMON_REFRESH_INTERVAL
+                )
+                self.next_runs[name] = now + interval
+                self.running[name] = asyncio.create_task(
+                    self.cycle(
+                        os_conf=os_conf,
+                        config=config,
+                        scheduler=scheduler,
+                        session_cache=session_cache,
+                        harvest_cache=harvest_cache,
+                    )
+                )
+
+            if self.pending_removal and len(os_confs) > 0:
+                await self.reconcile(os_confs)
+
+            if self.settings.METRICS_FILE:
+                await loop.run_in_executor(
+                    None, metrics.write, self.settings.METRICS_FILE
+                )
+            await asyncio.sleep(self.settings.DAEMON_POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    logger.setLevel(logging.DEBUG)
+    asyncio.run(Daemon(base_path=".").run())
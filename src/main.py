@@ -1,59 +1,174 @@
+import argparse
+import asyncio
 import logging
-import os
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from typing import List
+import sys
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, ContextManager, List, Optional
 
-from app.provider.schemas_extended import ProviderCreateExtended
+from config import get_settings
 from logger import logger
-from models.provider import Openstack, TrustedIDP
-from providers.opnstk import get_provider
-from utils import load_config, load_federation_registry_config, update_database
+from metrics import metrics
+from utils import (
+    get_failures_summary,
+    is_owned,
+    list_config_files,
+    load_configs,
+    load_federation_registry_config,
+    update_database,
+)
 
-MAX_WORKERS = 7
-data_lock = Lock()
+# openstacksdk and the Federation Registry schemas are imported only when there
+# is something to harvest.
+if TYPE_CHECKING:
+    from app.provider.schemas_extended import ProviderCreateExtended
+    from models.provider import SiteConfig
 
 
-def add_os_provider_to_list(
-    os_conf: Openstack,
-    trusted_idps: List[TrustedIDP],
-    providers: List[ProviderCreateExtended],
-):
-    """Add Openstack providers to the provider lists."""
-    provider = get_provider(os_conf=os_conf, trusted_idps=trusted_idps)
-    with data_lock:
-        providers.append(provider)
+async def harvest(*, configs: List["SiteConfig"]) -> List["ProviderCreateExtended"]:
+    """Harvest all the providers defined in the given configurations.
 
+    A single event loop drives every provider. Blocking openstacksdk calls of all
+    providers share one scheduler with a global and a per-site cap.
+    """
+    from providers.cache import HarvestCache
+    from providers.opnstk import TIMEOUT, get_provider
+    from providers.sessions import SessionCache
+    from scheduler import Scheduler
 
-if __name__ == "__main__":
-    base_path = "."
-    logger.setLevel(logging.DEBUG)
+    settings = get_settings()
+    scheduler = Scheduler(
+        max_workers=settings.MAX_WORKERS,
+        max_workers_per_site=settings.MAX_WORKERS_PER_SITE,
+        max_retries=settings.MAX_RETRIES,
+        backoff=settings.RETRY_BACKOFF,
+        breaker_threshold=settings.CIRCUIT_BREAKER_THRESHOLD,
+        breaker_reset_timeout=settings.CIRCUIT_BREAKER_RESET,
+        hedge_percentile=settings.HEDGE_PERCENTILE,
+    )
+    session_cache = SessionCache(timeout=TIMEOUT)
+    harvest_cache = HarvestCache(
+        path=settings.HARVEST_CACHE_DIR,
+        full_refresh_interval=settings.HARVEST_CACHE_FULL_REFRESH,
+    )
 
-    # Load Federation Registry configuration
-    federation_registry_urls = load_federation_registry_config(base_path=base_path)
+    # With sharding, other replicas harvest the providers not owned by this one.
+    os_confs = [
+        (os_conf, config)
+        for config in configs
+        for os_conf in config.openstack
+        if is_owned(os_conf.name)
+    ]
+    results = await asyncio.gather(
+        *[
+            get_provider(
+                os_conf=os_conf,
+                site_config=config,
+                scheduler=scheduler,
+                session_cache=session_cache,
+                harvest_cache=harvest_cache,
+            )
+            for os_conf, config in os_confs
+        ],
+        return_exceptions=True,
+    )
+    scheduler.shutdown()
+    session_cache.clear()
 
     providers = []
-    thread_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    for (os_conf, _), result in zip(os_confs, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to harvest provider={os_conf.name}: {result!r}")
+        else:
+            providers.append(result)
+    return providers
+
+
+def profile_phase(run_dir: Optional[str], phase: str) -> ContextManager[None]:
+    """Profile the phase when profiling is enabled."""
+    if run_dir is None:
+        return nullcontext()
+    from profiling import profile_phase
+
+    return profile_phase(run_dir, phase)
+
+
+def main(*, base_path: str = ".", profile: bool = False) -> int:
+    """Harvest the configured providers and update the Federation Registry.
+
+    When profile is True, CPU and allocation profiles of the harvest and of the
+    sync phases are saved in a new directory of PROFILE_DIR.
+
+    Return the exit status: 1 if any Federation Registry operation failed.
+    """
+    settings = get_settings()
+    run_dir = None
+    if profile:
+        from profiling import create_run_dir
+
+        run_dir = create_run_dir(path=settings.PROFILE_DIR, keep=settings.PROFILE_KEEP)
+
+    # Load Federation Registry configuration
+    federation_registry_urls = load_federation_registry_config(base_path=base_path)
 
     # Read all yaml files containing providers configurations.
-    # Multithreading read.
-    yaml_files = list(
-        filter(lambda x: x.endswith(".config.yaml"), os.listdir(base_path))
-    )
-    for file in yaml_files:
-        config = load_config(fname=file)
-        for os_conf in config.openstack:
-            thread_pool.submit(
-                add_os_provider_to_list,
-                os_conf=os_conf,
-                trusted_idps=config.trusted_idps,
-                providers=providers,
-            )
-    thread_pool.shutdown(wait=True)
+    yaml_files = list_config_files(base_path=base_path)
+    if len(yaml_files) == 0:
+        logger.info("No provider configuration found. Nothing to do")
+        return 0
+    configs = load_configs(fnames=yaml_files)
+
+    with profile_phase(run_dir, "harvest"):
+        providers = asyncio.run(harvest(configs=configs))
+
+    # Providers whose harvest failed are kept in the Federation Registry.
+    harvested = {i.name for i in providers}
+    failed = [
+        os_conf.name
+        for config in configs
+        for os_conf in config.openstack
+        if is_owned(os_conf.name) and os_conf.name not in harvested
+    ]
 
     # Update the Federation Registry
-    update_database(
-        federation_registry_urls=federation_registry_urls,
-        token=config.trusted_idps[0].token,
-        items=providers,
+    with profile_phase(run_dir, "sync"):
+        results = update_database(
+            federation_registry_urls=federation_registry_urls,
+            token=configs[-1].trusted_idps[0].token,
+            items=providers,
+            protected=failed,
+        )
+
+    if settings.METRICS_FILE:
+        metrics.write(settings.METRICS_FILE)
+
+    failures_summary = get_failures_summary(results)
+    if failures_summary is not None:
+        logger.error(failures_summary)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Harvest the configured providers and update the Federation "
+        "Registry"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="save CPU and allocation profiles of the harvest and sync phases",
     )
+    parser.add_argument(
+        "--profile-diff",
+        nargs=2,
+        metavar=("OLD_RUN", "NEW_RUN"),
+        help="compare the profiles saved in two run directories and exit",
+    )
+    args = parser.parse_args()
+    if args.profile_diff is not None:
+        from profiling import diff_runs
+
+        print(diff_runs(*args.profile_diff))
+    else:
+        logger.setLevel(logging.DEBUG)
+        sys.exit(main(base_path=".", profile=args.profile))
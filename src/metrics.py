@@ -0,0 +1,244 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import (
+    Any,
+    Awaitable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+# Labels of every series: unused ones are left empty.
+LABELS = ("phase", "provider", "region", "project")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Key = Tuple[str, str, str, str]
+
+
+class CallTimes(NamedTuple):
+    """Seconds spent by the scheduled calls of a timed block in worker threads, and
+    waiting for them, retry backoffs included.
+
+    Appended by the scheduler, from worker threads too.
+    """
+
+    busy: List[float]
+    waiting: List[float]
+
+
+# Call times of the block timed by the current task.
+_call_times: ContextVar[Optional[CallTimes]] = ContextVar("call_times", default=None)
+
+
+def get_call_times() -> Optional[CallTimes]:
+    """Return the call times of the current timed block, if any."""
+    return _call_times.get()
+
+
+def escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Durations, waits, call counts, item counts and bytes of each phase of a run,
+    labelled by provider, region and project.
+
+    Thread safe. Rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self, *, prefix: str = "feeder") -> None:
+        self.prefix = prefix
+        self._lock = Lock()
+        self._seconds: Dict[Key, float] = defaultdict(float)
+        self._waits: Dict[Key, float] = defaultdict(float)
+        self._calls: Dict[Key, int] = defaultdict(int)
+        self._failures: Dict[Key, int] = defaultdict(int)
+        self._items: Dict[Key, int] = defaultdict(int)
+        self._bytes: Dict[Key, int] = defaultdict(int)
+
+    def observe(
+        self,
+        phase: str,
+        seconds: float,
+        *,
+        failed: bool = False,
+        provider: str = "",
+        region: str = "",
+        project: str = "",
+    ) -> None:
+        """Record a call of the phase."""
+        key = (phase, provider, region, project)
+        with self._lock:
+            self._seconds[key] += seconds
+            self._calls[key] += 1
+            if failed:
+                self._failures[key] += 1
+
+    def add_wait(
+        self,
+        phase: str,
+        seconds: float,
+        *,
+        provider: str = "",
+        region: str = "",
+        project: str = "",
+    ) -> None:
+        """Record the time the calls of the phase waited for a worker."""
+        with self._lock:
+            self._waits[(phase, provider, region, project)] += seconds
+
+    def add_items(
+        self,
+        phase: str,
+        count: int,
+        *,
+        provider: str = "",
+        region: str = "",
+        project: str = "",
+    ) -> None:
+        """Record the number of items retrieved or sent by the phase."""
+        with self._lock:
+            self._items[(phase, provider, region, project)] += count
+
+    def add_bytes(
+        self,
+        phase: str,
+        count: int,
+        *,
+        provider: str = "",
+        region: str = "",
+        project: str = "",
+    ) -> None:
+        """Record the number of bytes transferred by the phase."""
+        with self._lock:
+            self._bytes[(phase, provider, region, project)] += count
+
+    @contextmanager
+    def timer(self, phase: str, **labels: str) -> Iterator[None]:
+        """Record the duration of the wrapped block, and whether it failed."""
+        start = time.monotonic()
+        try:
+            yield
+        except BaseException:
+            self.observe(phase, time.monotonic() - start, failed=True, **labels)
+            raise
+        self.observe(phase, time.monotonic() - start, **labels)
+
+    async def timed(self, phase: str, aw: Awaitable[T], **labels: str) -> T:
+        """Await and record the time spent in the scheduled calls, the time they
+        waited for a worker, and the items returned as a list.
+
+        Concurrent calls add up their durations.
+        """
+        times = CallTimes(busy=[], waiting=[])
+        parent = _call_times.get()
+        token = _call_times.set(times)
+        failed = True
+        try:
+            result = await aw
+            failed = False
+        finally:
+            _call_times.reset(token)
+            busy, waiting = sum(times.busy), sum(times.waiting)
+            # Nested blocks count in the enclosing one too.
+            if parent is not None:
+                parent.busy.append(busy)
+                parent.waiting.append(waiting)
+            self.observe(phase, busy, failed=failed, **labels)
+            self.add_wait(phase, waiting, **labels)
+        if isinstance(result, list):
+            self.add_items(phase, len(result), **labels)
+        return result
+
+    def render(self) -> str:
+        """Return the metrics in the Prometheus text format."""
+        families: List[Tuple[str, str, str, Dict[Key, Any]]] = [
+            (
+                "phase_seconds_total",
+                "counter",
+                "Time spent in each phase, waits excluded",
+                self._seconds,
+            ),
+            (
+                "phase_wait_seconds_total",
+                "counter",
+                "Time the calls of each phase waited for a worker or a retry",
+                self._waits,
+            ),
+            ("phase_calls_total", "counter", "Calls of each phase", self._calls),
+            (
+                "phase_failures_total",
+                "counter",
+                "Failed calls of each phase",
+                self._failures,
+            ),
+            (
+                "phase_items_total",
+                "counter",
+                "Items retrieved or sent by each phase",
+                self._items,
+            ),
+            (
+                "phase_bytes_total",
+                "counter",
+                "Bytes transferred by each phase",
+                self._bytes,
+            ),
+        ]
+        lines = []
+        with self._lock:
+            for name, kind, description, values in families:
+                name = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(values.items()):
+                    labels = ",".join(
+                        f'{k}="{escape(v)}"' for k, v in zip(LABELS, key) if v
+                    )
+                    if labels:
+                        lines.append(f"{name}{{{labels}}} {value}")
+                    else:
+                        lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Atomically write the metrics in a textfile collector file."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """Expose the metrics on the given port from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("content-type", CONTENT_TYPE)
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = Metrics()
@@ -1,5 +1,4 @@
-import subprocess
-from typing import List, Optional
+from typing import Any, Dict, List, NamedTuple, Optional
 from uuid import UUID
 
 from app.auth_method.schemas import AuthMethodBase
@@ -12,7 +11,14 @@ from app.quota.schemas import BlockStorageQuotaBase, ComputeQuotaBase, NetworkQu
 from app.region.schemas import RegionBase
 from app.sla.schemas import SLABase
 from app.user_group.schemas import UserGroupBase
-from pydantic import AnyHttpUrl, BaseModel, Field, root_validator, validator
+from pydantic import (
+    AnyHttpUrl,
+    BaseModel,
+    Field,
+    PrivateAttr,
+    root_validator,
+    validator,
+)
 
 
 class SLA(SLABase):
@@ -46,31 +52,31 @@ class UserGroup(UserGroupBase):
 
 class TrustedIDP(IdentityProviderBase):
     issuer: AnyHttpUrl = Field(description="issuer url")
-    token: str = Field(description="Access token")
+    token: Optional[str] = Field(
+        default=None, description="Access token. Generated after loading when missing"
+    )
     user_groups: List[UserGroup] = Field(
         default_factory=list, description="User groups"
     )
     relationship: Optional[AuthMethodBase] = Field(default=None, description="")
 
+    _generated_token: bool = PrivateAttr(default=False)
+
     @root_validator(pre=True)
     def rename_issuer_to_endpoint(cls, values):
         values["endpoint"] = values.get("issuer")
-        # Generate token
-        if values.get("token") is None:
-            token_cmd = subprocess.run(
-                [
-                    "docker",
-                    "exec",
-                    "federation-registry_devcontainer-oidc-agent-1",
-                    "oidc-token",
-                    values.get("endpoint"),
-                ],
-                stdout=subprocess.PIPE,
-                text=True,
-            )
-            values["token"] = token_cmd.stdout.strip("\n")
         return values
 
+    @property
+    def needs_generated_token(self) -> bool:
+        """Return True if the token is missing or was generated."""
+        return self.token is None or self._generated_token
+
+    def set_generated_token(self, token: str) -> None:
+        """Set a generated token, to renew before it expires."""
+        self.token = token
+        self._generated_token = True
+
 
 class Limits(BaseModel):
     block_storage: Optional[BlockStorageQuotaBase] = Field(
@@ -189,6 +195,11 @@ class Provider(ProviderBase):
     regions: List[Region] = Field(
         default_factory=list, description="List of hosted regions"
     )
+    refresh_interval: Optional[int] = Field(
+        default=None,
+        gt=0,
+        description="Seconds between two harvests when running as a daemon",
+    )
 
 
 class Openstack(Provider):
@@ -231,6 +242,12 @@ class Kubernetes(Provider):
         return v
 
 
+class SLAOwner(NamedTuple):
+    trusted_idp: TrustedIDP
+    user_group: UserGroup
+    sla: SLA
+
+
 class SiteConfig(BaseModel):
     trusted_idps: List[TrustedIDP] = Field(
         description="List of OIDC-Agent supported identity providers endpoints"
@@ -243,3 +260,19 @@ class SiteConfig(BaseModel):
         default_factory=list,
         description="Openstack providers to integrate in the Federation Registry",
     )
+
+    _slas: Dict[str, SLAOwner] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        # Index SLAs by document UUID. The first occurrence wins.
+        for trusted_idp in self.trusted_idps:
+            for user_group in trusted_idp.user_groups:
+                for sla in user_group.slas:
+                    self._slas.setdefault(
+                        sla.doc_uuid, SLAOwner(trusted_idp, user_group, sla)
+                    )
+
+    def get_sla(self, doc_uuid: str) -> Optional[SLAOwner]:
+        """Return the SLA with the given document UUID and the IDP owning it."""
+        return self._slas.get(doc_uuid)
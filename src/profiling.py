@@ -0,0 +1,136 @@
+import cProfile
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from logger import logger
+
+PHASES = ("harvest", "sync")
+
+# Number of frames stored for each traced allocation.
+TRACEMALLOC_FRAMES = 1
+
+# From Python 3.12, a single profiler can be active and it sees every thread.
+PROFILER_PER_THREAD = sys.version_info < (3, 12)
+
+# pstats function key: (file, line, function name).
+FuncKey = Tuple[str, int, str]
+
+
+class ThreadStats:
+    """Statistics of a profiler enabled in another thread.
+
+    cProfile can only be disabled from the thread it profiles, so the statistics
+    are read without disabling it.
+    """
+
+    def __init__(self, profile: cProfile.Profile) -> None:
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+def create_run_dir(*, path: str, keep: int) -> str:
+    """Create the directory of a new run, removing the oldest beyond keep."""
+    os.makedirs(path, exist_ok=True)
+    run_dir = os.path.join(path, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}")
+    os.makedirs(run_dir)
+    runs = sorted(i for i in os.listdir(path) if os.path.isdir(os.path.join(path, i)))
+    for old in runs[: max(len(runs) - keep, 0)]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return run_dir
+
+
+@contextmanager
+def profile_phase(run_dir: str, phase: str) -> Iterator[None]:
+    """Save a CPU profile and an allocation snapshot of the wrapped phase.
+
+    Threads started during the phase, as the workers of the scheduler and of the
+    registry sync, are profiled too: by a profiler of their own before Python 3.12,
+    by the single active profiler from Python 3.12.
+    """
+    profiles: List[cProfile.Profile] = []
+    lock = threading.Lock()
+
+    def enable_in_thread(*args: Any) -> None:
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    if PROFILER_PER_THREAD:
+        threading.setprofile(enable_in_thread)
+    main = cProfile.Profile()
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        if PROFILER_PER_THREAD:
+            threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(main)
+        with lock:
+            for profile in profiles:
+                stats.add(ThreadStats(profile))
+        stats.dump_stats(os.path.join(run_dir, f"{phase}.prof"))
+        snapshot.dump(os.path.join(run_dir, f"{phase}.snapshot"))
+        logger.info(f"Profiles of phase {phase} saved in {run_dir}")
+
+
+def load_hot_functions(fname: str) -> Dict[FuncKey, float]:
+    """Return the time spent in each function, excluding sub-calls."""
+    stats = pstats.Stats(fname)
+    return {func: value[2] for func, value in stats.stats.items()}
+
+
+def load_snapshot(fname: str) -> tracemalloc.Snapshot:
+    """Return the allocation snapshot without the allocations of the profilers."""
+    return tracemalloc.Snapshot.load(fname).filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
+
+
+def diff_runs(old_dir: str, new_dir: str, *, limit: int = 20) -> str:
+    """Compare the top allocators and the hot functions of two profiled runs."""
+    lines = [f"Comparing {new_dir} to {old_dir}"]
+    for phase in PHASES:
+        old_prof = os.path.join(old_dir, f"{phase}.prof")
+        new_prof = os.path.join(new_dir, f"{phase}.prof")
+        old_snapshot = os.path.join(old_dir, f"{phase}.snapshot")
+        new_snapshot = os.path.join(new_dir, f"{phase}.snapshot")
+        if not all(
+            os.path.isfile(i) for i in (old_prof, new_prof, old_snapshot, new_snapshot)
+        ):
+            lines.append(f"\n[{phase}] Missing profiles. Skipped")
+            continue
+
+        lines.append(f"\n[{phase}] Top allocators")
+        diff = load_snapshot(new_snapshot).compare_to(
+            load_snapshot(old_snapshot), "lineno"
+        )
+        lines.extend(str(i) for i in diff[:limit])
+
+        lines.append(f"\n[{phase}] Hot functions (own time, difference)")
+        old = load_hot_functions(old_prof)
+        new = load_hot_functions(new_prof)
+        hot = sorted(new.items(), key=lambda x: x[1], reverse=True)[:limit]
+        for (fname, line, func), seconds in hot:
+            delta = seconds - old.get((fname, line, func), 0)
+            lines.append(f"{seconds:10.3f}s {delta:+10.3f}s  {fname}:{line}({func})")
+    return "\n".join(lines)
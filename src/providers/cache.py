@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from logger import logger
+from pydantic import BaseModel, Field
+
+
+class CachedItem(BaseModel):
+    revision: str = Field(description="Change marker of the harvested entity")
+    data: Dict[str, Any] = Field(description="Harvested entity data")
+
+
+class Snapshot(BaseModel):
+    refreshed_at: float = Field(
+        default_factory=time.time, description="Timestamp of the last full listing"
+    )
+    marker: Optional[str] = Field(
+        default=None, description="Most recent change marker seen (i.e. updated_at)"
+    )
+    items: Dict[str, CachedItem] = Field(
+        default_factory=dict, description="Harvested entities, keyed by ID"
+    )
+
+
+class HarvestCache:
+    """On disk snapshots of the entities harvested from a project.
+
+    Snapshots are keyed by (provider, region, project, resource type). A snapshot
+    older than the full refresh interval is discarded, so that entities deleted
+    upstream eventually disappear.
+    """
+
+    def __init__(self, *, path: str, full_refresh_interval: float) -> None:
+        self.path = path
+        self.full_refresh_interval = full_refresh_interval
+        os.makedirs(path, exist_ok=True)
+
+    def _fname(self, key: Tuple[str, ...]) -> str:
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.path, f"{digest}.json")
+
+    def load(self, key: Tuple[str, ...]) -> Snapshot:
+        """Return the stored snapshot or an empty one when a full listing is due."""
+        fname = self._fname(key)
+        if os.path.isfile(fname):
+            try:
+                snapshot = Snapshot.parse_file(fname)
+            except ValueError as e:
+                logger.warning(f"Ignoring corrupted harvest cache {fname}: {e!r}")
+            else:
+                if time.time() - snapshot.refreshed_at < self.full_refresh_interval:
+                    return snapshot
+        return Snapshot()
+
+    def store(self, key: Tuple[str, ...], snapshot: Snapshot) -> None:
+        """Atomically write the snapshot on disk.
+
+        Concurrent writers use distinct temporary files.
+        """
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.path, prefix=".snapshot.", delete=False
+        ) as f:
+            f.write(snapshot.json())
+        os.replace(f.name, self._fname(key))
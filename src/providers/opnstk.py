@@ -1,8 +1,17 @@
-import copy
+import asyncio
+import json
 import os
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
-from typing import List, Optional
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 from app.provider.enum import ProviderStatus
 from app.provider.schemas_extended import (
@@ -28,21 +37,35 @@ from app.service.enum import (
     IdentityServiceName,
     NetworkServiceName,
 )
+from config import get_settings
 from logger import logger
+from metrics import metrics
 from models.provider import (
     AuthMethod,
     Openstack,
     PrivateNetProxy,
     Project,
+    SiteConfig,
     TrustedIDP,
 )
-from openstack import connect
+from openstack.compute.v2.flavor import Flavor
 from openstack.connection import Connection
+from openstack.image.v2.image import Image
+from providers.cache import CachedItem, HarvestCache, Snapshot
+from providers.sessions import SessionCache
+from scheduler import Scheduler, deadline, with_deadline
 
 TIMEOUT = 2  # s
 
-projects_lock = Lock()
-region_lock = Lock()
+ServiceT = TypeVar(
+    "ServiceT",
+    bound=Union[
+        BlockStorageServiceCreateExtended,
+        ComputeServiceCreateExtended,
+        IdentityServiceCreate,
+        NetworkServiceCreateExtended,
+    ],
+)
 
 
 def get_block_storage_quotas(conn: Connection) -> BlockStorageQuotaCreateExtended:
@@ -70,62 +93,190 @@ def get_network_quotas(conn: Connection) -> NetworkQuotaCreateExtended:
     return NetworkQuotaCreateExtended(**data, project=conn.current_project_id)
 
 
-def get_flavors(conn: Connection) -> List[FlavorCreateExtended]:
+def list_flavors(conn: Connection) -> List[Flavor]:
     logger.info("Retrieve current project accessible flavors")
-    flavors = []
-    for flavor in conn.compute.flavors(is_disabled=False):
+    return list(conn.compute.flavors(is_disabled=False))
+
+
+def get_flavor_access(conn: Connection, flavor: Flavor) -> List[str]:
+    logger.info(f"Retrieve projects allowed to use flavor {flavor.id}")
+    return [i.get("tenant_id") for i in conn.compute.get_flavor_access(flavor)]
+
+
+def build_flavor(data: Dict[str, Any], projects: List[str]) -> FlavorCreateExtended:
+    data = dict(data)
+    data["uuid"] = data.pop("id")
+    if data.get("description") is None:
+        data["description"] = ""
+    extra = data.pop("extra_specs")
+    if extra:
+        data["gpus"] = int(extra.get("gpu_number", 0))
+        data["gpu_model"] = extra.get("gpu_model") if data["gpus"] > 0 else None
+        data["gpu_vendor"] = extra.get("gpu_vendor") if data["gpus"] > 0 else None
+        data["local_storage"] = extra.get(
+            "aggregate_instance_extra_specs:local_storage"
+        )
+        data["infiniband"] = extra.get("infiniband", False)
+    logger.debug(f"Flavor manipulated data={data}")
+    return FlavorCreateExtended(**data, projects=projects)
+
+
+class FlavorCatalog:
+    """Flavors of a region, shared by the harvest of all its projects.
+
+    Each project lists the flavors it can see, but every flavor is processed, and
+    its access list retrieved, once per region. Access lists are retrieved
+    concurrently through the scheduler.
+    """
+
+    def __init__(self, *, scheduler: Scheduler, site: str) -> None:
+        self.scheduler = scheduler
+        self.site = site
+        self._flavors: Dict[str, "asyncio.Future[FlavorCreateExtended]"] = {}
+
+    async def _build(self, conn: Connection, flavor: Flavor) -> FlavorCreateExtended:
         logger.debug(f"Flavor received data={flavor!r}")
         projects = []
         if not flavor.is_public:
-            for i in conn.compute.get_flavor_access(flavor):
-                projects.append(i.get("tenant_id"))
-        data = flavor.to_dict()
-        data["uuid"] = data.pop("id")
-        if data.get("description") is None:
-            data["description"] = ""
-        extra = data.pop("extra_specs")
-        if extra:
-            data["gpus"] = int(extra.get("gpu_number", 0))
-            data["gpu_model"] = extra.get("gpu_model") if data["gpus"] > 0 else None
-            data["gpu_vendor"] = extra.get("gpu_vendor") if data["gpus"] > 0 else None
-            data["local_storage"] = extra.get(
-                "aggregate_instance_extra_specs:local_storage"
+            projects = await self.scheduler.read(
+                self.site, get_flavor_access, conn, flavor
             )
-            data["infiniband"] = extra.get("infiniband", False)
-        logger.debug(f"Flavor manipulated data={data}")
-        flavors.append(FlavorCreateExtended(**data, projects=projects))
-    return flavors
+        return build_flavor(flavor.to_dict(), projects)
+
+    async def get(self, conn: Connection, flavor: Flavor) -> FlavorCreateExtended:
+        """Return the processed flavor, building it only once per region."""
+        future = self._flavors.get(flavor.id)
+        if future is None:
+            future = asyncio.ensure_future(self._build(conn, flavor))
+            self._flavors[flavor.id] = future
+        # Do not cancel the shared build when a single project is cancelled.
+        return await asyncio.shield(future)
+
+
+async def get_flavors(
+    conn: Connection, *, catalog: FlavorCatalog
+) -> List[FlavorCreateExtended]:
+    """Retrieve flavors.
+
+    Nova has no change marker for flavors: they are always listed and, with the
+    access list of the private ones, not cached between runs.
+    """
+    flavors = await catalog.scheduler.read(catalog.site, list_flavors, conn)
+    return list(await asyncio.gather(*[catalog.get(conn, i) for i in flavors]))
+
+
+def list_images(
+    conn: Connection, *, tags: List[str], marker: Optional[str]
+) -> List[Image]:
+    if marker is None:
+        logger.info("Retrieve current project accessible images")
+        return list(
+            conn.image.images(status="active", tag=None if len(tags) == 0 else tags)
+        )
+    logger.info(f"Retrieve images updated since {marker}")
+    return list(conn.image.images(updated_at=f"gte:{marker}"))
+
+
+def get_image_members(conn: Connection, image: Image) -> List[str]:
+    logger.info(f"Retrieve projects accepting image {image.id}")
+    return [i.id for i in conn.image.members(image) if i.status == "accepted"]
+
+
+def build_image(image: Image, members: List[str]) -> ImageCreateExtended:
+    is_public = True
+    projects = []
+    if image.visibility in ["private", "shared"]:
+        projects = [image.owner_id, *members]
+        is_public = False
+    data = image.to_dict()
+    data["uuid"] = data.pop("id")
+    if data.get("description") is None:
+        data["description"] = ""
+    data["is_public"] = is_public
+    logger.debug(f"Image manipulated data={data}")
+    return ImageCreateExtended(**data, projects=projects)
+
 
+class ImageCatalog:
+    """Members of the shared images of a region, shared by all its projects.
 
-def get_images(
-    conn: Connection, tags: Optional[List[str]] = None
+    Members are retrieved concurrently through the scheduler, once per (image,
+    updated_at) pair. Results are kept in the given snapshot, which survives
+    between runs, so unchanged images are not queried again.
+    """
+
+    def __init__(
+        self, *, scheduler: Scheduler, site: str, snapshot: Optional[Snapshot] = None
+    ) -> None:
+        self.scheduler = scheduler
+        self.site = site
+        self.snapshot = Snapshot() if snapshot is None else snapshot
+        self._members: Dict[Tuple[str, str], "asyncio.Future[List[str]]"] = {}
+
+    async def _fetch(self, conn: Connection, image: Image) -> List[str]:
+        members = await self.scheduler.read(self.site, get_image_members, conn, image)
+        self.snapshot.items[image.id] = CachedItem(
+            revision=image.updated_at, data={"members": members}
+        )
+        return members
+
+    async def get_members(self, conn: Connection, image: Image) -> List[str]:
+        """Return the projects which accepted a shared image."""
+        if image.visibility != "shared":
+            return []
+        cached = self.snapshot.items.get(image.id)
+        if cached is not None and cached.revision == image.updated_at:
+            return cached.data["members"]
+        key = (image.id, image.updated_at)
+        future = self._members.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(conn, image))
+            self._members[key] = future
+        return await asyncio.shield(future)
+
+
+async def get_images(
+    conn: Connection,
+    *,
+    catalog: ImageCatalog,
+    tags: Optional[List[str]] = None,
+    snapshot: Optional[Snapshot] = None,
 ) -> List[ImageCreateExtended]:
+    """Retrieve images.
+
+    When the given snapshot has a change marker, list only the images updated
+    since then and merge them into the snapshot. Otherwise list all of them.
+    The snapshot is updated in place.
+    """
     if tags is None:
         tags = []
-    logger.info("Retrieve current project accessible images")
-    images = []
-    for image in conn.image.images(
-        status="active", tag=None if len(tags) == 0 else tags
-    ):
+    if snapshot is None:
+        snapshot = Snapshot()
+    if snapshot.marker is None:
+        snapshot.items = {}
+    images = await catalog.scheduler.read(
+        catalog.site, list_images, conn, tags=tags, marker=snapshot.marker
+    )
+
+    changed = []
+    for image in images:
         logger.debug(f"Image received data={image!r}")
-        is_public = True
-        projects = []
-        if image.visibility in ["private", "shared"]:
-            projects = [image.owner_id]
-            is_public = False
-        if image.visibility == "shared":
-            members = list(conn.image.members(image))
-            for member in members:
-                if member.status == "accepted":
-                    projects.append(member.id)
-        data = image.to_dict()
-        data["uuid"] = data.pop("id")
-        if data.get("description") is None:
-            data["description"] = ""
-        data["is_public"] = is_public
-        logger.debug(f"Image manipulated data={data}")
-        images.append(ImageCreateExtended(**data, projects=projects))
-    return images
+        if snapshot.marker is None or image.updated_at > snapshot.marker:
+            snapshot.marker = image.updated_at
+        if image.status != "active" or not set(tags).issubset(image.tags or []):
+            snapshot.items.pop(image.id, None)
+            continue
+        cached = snapshot.items.get(image.id)
+        if cached is None or cached.revision != image.updated_at:
+            changed.append(image)
+
+    members = await asyncio.gather(*[catalog.get_members(conn, i) for i in changed])
+    for image, image_members in zip(changed, members):
+        item = build_image(image, image_members)
+        snapshot.items[image.id] = CachedItem(
+            revision=image.updated_at, data=json.loads(item.json())
+        )
+    return [ImageCreateExtended(**i.data) for i in snapshot.items.values()]
 
 
 def get_networks(
@@ -135,6 +286,11 @@ def get_networks(
     proxy: Optional[PrivateNetProxy] = None,
     tags: Optional[List[str]] = None,
 ) -> List[NetworkCreateExtended]:
+    """Retrieve networks.
+
+    Neutron only filters on the exact revision number: networks are always listed
+    and not cached between runs.
+    """
     if tags is None:
         tags = []
     logger.info("Retrieve current project accessible networks")
@@ -165,6 +321,32 @@ def get_networks(
     return networks
 
 
+async def load_snapshot(harvest_cache: HarvestCache, key: Tuple[str, ...]) -> Snapshot:
+    """Read a snapshot in a worker thread, outside the caps of the sites."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, harvest_cache.load, key)
+
+
+async def store_snapshots(
+    harvest_cache: HarvestCache, snapshots: Dict[Tuple[str, ...], Snapshot]
+) -> None:
+    """Write the snapshots in worker threads, outside the caps of the sites.
+
+    A failed write is only logged: the next run starts from the previous snapshot.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(None, harvest_cache.store, key, snapshot)
+            for key, snapshot in snapshots.items()
+        ],
+        return_exceptions=True,
+    )
+    for key, result in zip(snapshots, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to store harvest cache {key}: {result!r}")
+
+
 def get_project(conn: Connection) -> ProjectCreate:
     logger.info("Retrieve current project data")
     project = conn.identity.get_project(conn.current_project_id)
@@ -177,38 +359,172 @@ def get_project(conn: Connection) -> ProjectCreate:
     return ProjectCreate(**data)
 
 
-def get_correct_idp_and_user_group_for_project(
+class ProjectAccess(NamedTuple):
+    trusted_idp: TrustedIDP
+    auth_method: AuthMethod
+
+
+def get_project_accesses(
+    *, os_conf: Openstack, site_config: SiteConfig
+) -> Tuple[Dict[str, ProjectAccess], Dict[str, List[str]]]:
+    """Assign the provider's projects to the SLAs they belong to.
+
+    Return the trusted IDP and the auth method to use to access each project, and
+    the projects each SLA applies to, including the ones listed in the SLA
+    configuration. Projects without a matching SLA or auth method are left out.
+    """
+    auth_methods: Dict[str, AuthMethod] = {}
+    for auth_method in os_conf.identity_providers:
+        auth_methods.setdefault(auth_method.endpoint, auth_method)
+
+    accesses: Dict[str, ProjectAccess] = {}
+    sla_projects: Dict[str, List[str]] = {}
+    for project_conf in os_conf.projects:
+        owner = site_config.get_sla(project_conf.sla)
+        if owner is None:
+            logger.error(
+                "Configuration error: No matching Identity Provider "
+                f"for project {project_conf.id}"
+            )
+            continue
+        projects = sla_projects.setdefault(project_conf.sla, list(owner.sla.projects))
+        if project_conf.id not in projects:
+            projects.append(project_conf.id)
+        auth_method = auth_methods.get(owner.trusted_idp.endpoint)
+        if auth_method is None:
+            logger.error(
+                "Configuration error: No auth method for Identity Provider "
+                f"{owner.trusted_idp.endpoint} and project {project_conf.id}"
+            )
+            continue
+        accesses[project_conf.id] = ProjectAccess(owner.trusted_idp, auth_method)
+    return accesses, sla_projects
+
+
+def get_identity_providers(
     *,
-    trusted_idps: List[TrustedIDP],
-    os_conf_auth_methods: List[AuthMethod],
-    project_conf: Project,
-) -> TrustedIDP:
-    for trusted_idp in trusted_idps:
-        for user_group in trusted_idp.user_groups:
+    site_config: SiteConfig,
+    accesses: Dict[str, ProjectAccess],
+    sla_projects: Dict[str, List[str]],
+) -> List[TrustedIDP]:
+    """Return the trusted IDPs with user groups having an SLA on a single project.
+
+    The site configuration is shared between providers and left untouched: the
+    returned IDPs are shallow copies with the provider's auth method and user
+    groups.
+    """
+    auth_methods = {i.trusted_idp.endpoint: i.auth_method for i in accesses.values()}
+    identity_providers = []
+    for idp in site_config.trusted_idps:
+        user_groups = []
+        for user_group in idp.user_groups:
             for sla in user_group.slas:
-                if sla.doc_uuid == project_conf.sla:
-                    if project_conf.id not in sla.projects:
-                        sla.projects.append(project_conf.id)
-                        for auth_method in os_conf_auth_methods:
-                            if auth_method.endpoint == trusted_idp.endpoint:
-                                trusted_idp.relationship = auth_method
-                                return trusted_idp
-                    return trusted_idp
-
-    logger.error(
-        "Configuration error: No matching Identity Provider "
-        f"for project {project_conf.id}"
+                projects = sla.projects
+                # Only the indexed SLA, the first one with that UUID, is assigned.
+                if site_config.get_sla(sla.doc_uuid).sla is sla:
+                    projects = sla_projects.get(sla.doc_uuid, projects)
+                if len(projects) == 1:
+                    new_sla = SLACreateExtended(**sla.dict(), project=projects[0])
+                    new_group = UserGroupCreateExtended(
+                        **user_group.dict(exclude={"slas"}), sla=new_sla
+                    )
+                    user_groups.append(new_group)
+        if len(user_groups) > 0:
+            identity_providers.append(
+                idp.copy(
+                    update={
+                        "relationship": auth_methods.get(
+                            idp.endpoint, idp.relationship
+                        ),
+                        "user_groups": user_groups,
+                    }
+                )
+            )
+    return identity_providers
+
+
+class ProjectDetails(NamedTuple):
+    """Services of a region as seen by a single project."""
+
+    project: ProjectCreate
+    compute_service: ComputeServiceCreateExtended
+    block_storage_service: BlockStorageServiceCreateExtended
+    network_service: NetworkServiceCreateExtended
+    identity_service: IdentityServiceCreate
+
+
+def merge_services(
+    services: List[ServiceT],
+    *,
+    unique: Tuple[str, ...] = (),
+    concat: Tuple[str, ...] = (),
+) -> List[ServiceT]:
+    """Merge the services sharing the same endpoint.
+
+    Resources listed in `unique` are deduplicated by UUID, keeping the first
+    occurrence. The ones listed in `concat` are concatenated. Other resources are
+    taken from the first service with that endpoint. The given services are not
+    modified.
+    """
+    merged: Dict[str, ServiceT] = {}
+    seen: Dict[str, Dict[str, Set[str]]] = {}
+    for service in services:
+        target = merged.get(service.endpoint)
+        if target is None:
+            merged[service.endpoint] = service.copy(
+                update={k: list(getattr(service, k)) for k in (*unique, *concat)}
+            )
+            seen[service.endpoint] = {
+                k: {i.uuid for i in getattr(service, k)} for k in unique
+            }
+            continue
+        for k in unique:
+            uuids = seen[service.endpoint][k]
+            for item in getattr(service, k):
+                if item.uuid not in uuids:
+                    uuids.add(item.uuid)
+                    getattr(target, k).append(item)
+        for k in concat:
+            getattr(target, k).extend(getattr(service, k))
+    return list(merged.values())
+
+
+def merge_region(
+    region: RegionCreateExtended, details: List[ProjectDetails]
+) -> RegionCreateExtended:
+    """Return a copy of the region with the services seen by its projects."""
+    return region.copy(
+        update={
+            "compute_services": merge_services(
+                [i.compute_service for i in details],
+                unique=("flavors", "images"),
+                concat=("quotas",),
+            ),
+            "block_storage_services": merge_services(
+                [i.block_storage_service for i in details], concat=("quotas",)
+            ),
+            "network_services": merge_services(
+                [i.network_service for i in details],
+                unique=("networks",),
+                concat=("quotas",),
+            ),
+            "identity_services": merge_services([i.identity_service for i in details]),
+        }
     )
-    raise
 
 
-def get_per_project_details(
+async def get_per_project_details(
     os_conf: Openstack,
     project_conf: Project,
     region: RegionCreateExtended,
-    trusted_idps: List[TrustedIDP],
-    projects: List[ProjectCreate],
-) -> None:
+    access: ProjectAccess,
+    scheduler: Scheduler,
+    session_cache: SessionCache,
+    harvest_cache: HarvestCache,
+    flavor_catalog: FlavorCatalog,
+    image_catalog: ImageCatalog,
+) -> ProjectDetails:
+    """Retrieve the services and the resources a project can access in a region."""
     default_private_net = project_conf.default_private_net
     default_public_net = project_conf.default_public_net
     proxy = project_conf.private_net_proxy
@@ -227,41 +543,108 @@ def get_per_project_details(
         proxy = region_props.private_net_proxy
         per_user_limits = region_props.per_user_limits
 
-    trusted_idp = get_correct_idp_and_user_group_for_project(
-        os_conf_auth_methods=os_conf.identity_providers,
-        trusted_idps=trusted_idps,
-        project_conf=project_conf,
-    )
-    if trusted_idp is None:
-        logger.error(f"Skipping project {project_conf.id}.")
-        return
-
     logger.info(
-        f"Connecting through IDP {trusted_idp.endpoint} to openstack "
+        f"Connecting through IDP {access.trusted_idp.endpoint} to openstack "
         f"'{os_conf.name}' and region '{region.name}'. "
         f"Accessing with project ID: {project_conf.id}"
     )
-    conn = connect(
-        auth_url=os_conf.auth_url,
-        auth_type="v3oidcaccesstoken",
-        identity_provider=trusted_idp.relationship.idp_name,
-        protocol=trusted_idp.relationship.protocol,
-        access_token=trusted_idp.token,
-        project_id=project_conf.id,
-        region_name=region.name,
-        timeout=TIMEOUT,
+    site = os_conf.auth_url
+    labels = {
+        "provider": os_conf.name,
+        "region": region.name,
+        "project": project_conf.id,
+    }
+    conn = await metrics.timed(
+        "keystone_connect",
+        scheduler.run(
+            site,
+            session_cache.connect,
+            auth_url=os_conf.auth_url,
+            identity_provider=access.auth_method.idp_name,
+            protocol=access.auth_method.protocol,
+            access_token=access.trusted_idp.token,
+            project_id=project_conf.id,
+            region_name=region.name,
+        ),
+        **labels,
     )
     logger.info("Connected.")
 
+    # Authenticate once, then fetch every resource of this project concurrently.
+    # Only Glance lists the changes since a marker: images are the only resources
+    # harvested incrementally.
+    images_key = (os_conf.name, region.name, project_conf.id, "images")
+    images_snapshot = await load_snapshot(harvest_cache, images_key)
+    compute_endpoint = await scheduler.read(site, conn.compute.get_endpoint)
+    (
+        flavors,
+        images,
+        compute_quotas,
+        block_storage_endpoint,
+        block_storage_quotas,
+        network_endpoint,
+        networks,
+        network_quotas,
+        project,
+    ) = await asyncio.gather(
+        metrics.timed(
+            "get_flavors",
+            get_flavors(conn, catalog=flavor_catalog),
+            **labels,
+        ),
+        metrics.timed(
+            "get_images",
+            get_images(
+                conn,
+                catalog=image_catalog,
+                tags=os_conf.image_tags,
+                snapshot=images_snapshot,
+            ),
+            **labels,
+        ),
+        metrics.timed(
+            "get_compute_quotas",
+            scheduler.read(site, get_compute_quotas, conn),
+            **labels,
+        ),
+        scheduler.read(site, conn.block_storage.get_endpoint),
+        metrics.timed(
+            "get_block_storage_quotas",
+            scheduler.read(site, get_block_storage_quotas, conn),
+            **labels,
+        ),
+        scheduler.read(site, conn.network.get_endpoint),
+        metrics.timed(
+            "get_networks",
+            scheduler.read(
+                site,
+                get_networks,
+                conn,
+                default_private_net=default_private_net,
+                default_public_net=default_public_net,
+                proxy=proxy,
+                tags=os_conf.network_tags,
+            ),
+            **labels,
+        ),
+        metrics.timed(
+            "get_network_quotas",
+            scheduler.read(site, get_network_quotas, conn),
+            **labels,
+        ),
+        scheduler.read(site, get_project, conn),
+    )
+    await store_snapshots(harvest_cache, {images_key: images_snapshot})
+
     # Create region's compute service.
     # Retrieve flavors, images and current project corresponding quotas.
     # Add them to the compute service.
     compute_service = ComputeServiceCreateExtended(
-        endpoint=conn.compute.get_endpoint(), name=ComputeServiceName.OPENSTACK_NOVA
+        endpoint=compute_endpoint, name=ComputeServiceName.OPENSTACK_NOVA
     )
-    compute_service.flavors = get_flavors(conn)
-    compute_service.images = get_images(conn, tags=os_conf.image_tags)
-    compute_service.quotas = [get_compute_quotas(conn)]
+    compute_service.flavors = flavors
+    compute_service.images = images
+    compute_service.quotas = [compute_quotas]
     if per_user_limits is not None and per_user_limits.compute is not None:
         compute_service.quotas.append(
             ComputeQuotaCreateExtended(
@@ -270,32 +653,15 @@ def get_per_project_details(
             )
         )
 
-    with region_lock:
-        for i, region_service in enumerate(region.compute_services):
-            if region_service.endpoint == compute_service.endpoint:
-                uuids = [j.uuid for j in region_service.flavors]
-                region.compute_services[i].flavors += list(
-                    filter(lambda x: x.uuid not in uuids, compute_service.flavors)
-                )
-                uuids = [j.uuid for j in region_service.images]
-                region.compute_services[i].images += list(
-                    filter(lambda x: x.uuid not in uuids, compute_service.images)
-                )
-                region.compute_services[i].quotas += compute_service.quotas
-                break
-        else:
-            region.compute_services.append(compute_service)
-
     # Retrieve project's block storage service.
     # Remove last part which corresponds to the project ID.
     # Retrieve current project corresponding quotas.
     # Add them to the block storage service.
-    endpoint = conn.block_storage.get_endpoint()
-    endpoint = os.path.dirname(endpoint)
+    endpoint = os.path.dirname(block_storage_endpoint)
     block_storage_service = BlockStorageServiceCreateExtended(
         endpoint=endpoint, name=BlockStorageServiceName.OPENSTACK_CINDER
     )
-    block_storage_service.quotas = [get_block_storage_quotas(conn)]
+    block_storage_service.quotas = [block_storage_quotas]
     if per_user_limits is not None and per_user_limits.block_storage is not None:
         block_storage_service.quotas.append(
             BlockStorageQuotaCreateExtended(
@@ -304,27 +670,13 @@ def get_per_project_details(
             )
         )
 
-    with region_lock:
-        for i, region_service in enumerate(region.block_storage_services):
-            if region_service.endpoint == block_storage_service.endpoint:
-                region.block_storage_services[i].quotas += block_storage_service.quotas
-                break
-        else:
-            region.block_storage_services.append(block_storage_service)
-
     # Retrieve region's network service.
     network_service = NetworkServiceCreateExtended(
-        endpoint=conn.network.get_endpoint(),
+        endpoint=network_endpoint,
         name=NetworkServiceName.OPENSTACK_NEUTRON,
     )
-    network_service.networks = get_networks(
-        conn,
-        default_private_net=default_private_net,
-        default_public_net=default_public_net,
-        proxy=proxy,
-        tags=os_conf.network_tags,
-    )
-    network_service.quotas = [get_network_quotas(conn)]
+    network_service.networks = networks
+    network_service.quotas = [network_quotas]
     if per_user_limits is not None and per_user_limits.network is not None:
         network_service.quotas.append(
             NetworkQuotaCreateExtended(
@@ -333,44 +685,38 @@ def get_per_project_details(
             )
         )
 
-    with region_lock:
-        for i, region_service in enumerate(region.network_services):
-            if region_service.endpoint == network_service.endpoint:
-                uuids = [j.uuid for j in region_service.networks]
-                region.network_services[i].networks += list(
-                    filter(lambda x: x.uuid not in uuids, network_service.networks)
-                )
-                break
-        else:
-            region.network_services.append(network_service)
-
     # Retrieve provider's identity service.
     identity_service = IdentityServiceCreate(
         endpoint=os_conf.auth_url,
         name=IdentityServiceName.OPENSTACK_KEYSTONE,
     )
-    with region_lock:
-        for region_service in region.identity_services:
-            if region_service.endpoint == identity_service.endpoint:
-                break
-        else:
-            region.identity_services.append(identity_service)
-
-    # Create project entity
-    project = get_project(conn)
-    with projects_lock:
-        if project.uuid not in [i.uuid for i in projects]:
-            projects.append(project)
 
     conn.close()
     logger.info("Connection closed")
 
+    return ProjectDetails(
+        project=project,
+        compute_service=compute_service,
+        block_storage_service=block_storage_service,
+        network_service=network_service,
+        identity_service=identity_service,
+    )
+
 
-def get_provider(
-    *, os_conf: Openstack, trusted_idps: List[TrustedIDP]
+async def get_provider(
+    *,
+    os_conf: Openstack,
+    site_config: SiteConfig,
+    scheduler: Scheduler,
+    session_cache: SessionCache,
+    harvest_cache: HarvestCache,
 ) -> ProviderCreateExtended:
     """Generate an Openstack virtual provider, reading information from a real openstack
     instance.
+
+    Every (region, project) pair is submitted at once to the run's scheduler, which
+    bounds the number of concurrent calls towards this provider. Raise if any of
+    them fails, so that a partial provider is never pushed.
     """
     if os_conf.status != ProviderStatus.ACTIVE:
         logger.info(f"Provider={os_conf.name} not active: {os_conf.status}")
@@ -382,44 +728,89 @@ def get_provider(
             status=os_conf.status,
         )
 
-    trust_idps = copy.deepcopy(trusted_idps)
-    regions: List[RegionCreateExtended] = []
-    projects: List[ProjectCreate] = []
-
-    for region_conf in os_conf.regions:
-        region = RegionCreateExtended(**region_conf.dict())
-        thread_pool = ThreadPoolExecutor(max_workers=len(os_conf.projects))
-        for project_conf in os_conf.projects:
-            thread_pool.submit(
-                get_per_project_details,
-                os_conf=os_conf,
-                project_conf=project_conf,
-                region=region,
-                trusted_idps=trust_idps,
-                projects=projects,
+    accesses, sla_projects = get_project_accesses(
+        os_conf=os_conf, site_config=site_config
+    )
+    regions = [RegionCreateExtended(**i.dict()) for i in os_conf.regions]
+    flavor_catalogs = {
+        region.name: FlavorCatalog(scheduler=scheduler, site=os_conf.auth_url)
+        for region in regions
+    }
+    members_keys = {
+        region.name: (os_conf.name, region.name, "image_members") for region in regions
+    }
+    members_snapshots = await asyncio.gather(
+        *[load_snapshot(harvest_cache, key) for key in members_keys.values()]
+    )
+    image_catalogs = {
+        region.name: ImageCatalog(
+            scheduler=scheduler, site=os_conf.auth_url, snapshot=snapshot
+        )
+        for region, snapshot in zip(regions, members_snapshots)
+    }
+    work_items = [
+        (region, project_conf)
+        for region in regions
+        for project_conf in os_conf.projects
+        if project_conf.id in accesses
+    ]
+    # A sick region or project fails on its own deadline, not the provider's.
+    settings = get_settings()
+    with deadline(settings.PROVIDER_DEADLINE):
+        results = await asyncio.gather(
+            *[
+                with_deadline(
+                    settings.PROJECT_DEADLINE,
+                    get_per_project_details(
+                        os_conf=os_conf,
+                        project_conf=project_conf,
+                        region=region,
+                        access=accesses[project_conf.id],
+                        scheduler=scheduler,
+                        session_cache=session_cache,
+                        harvest_cache=harvest_cache,
+                        flavor_catalog=flavor_catalogs[region.name],
+                        image_catalog=image_catalogs[region.name],
+                    ),
+                )
+                for region, project_conf in work_items
+            ],
+            return_exceptions=True,
+        )
+
+    # Reduce the per-project results, in submission order, into the regions.
+    details: Dict[str, List[ProjectDetails]] = {i.name: [] for i in regions}
+    projects: Dict[str, ProjectCreate] = {}
+    failures = 0
+    for (region, project_conf), result in zip(work_items, results):
+        if isinstance(result, Exception):
+            logger.error(
+                f"Failed to retrieve project {project_conf.id} details on "
+                f"provider '{os_conf.name}' and region '{region.name}': {result!r}"
             )
-        thread_pool.shutdown(wait=True)
-        regions.append(region)
+            failures += 1
+        else:
+            details[region.name].append(result)
+            projects.setdefault(result.project.uuid, result.project)
+    await store_snapshots(
+        harvest_cache,
+        {key: image_catalogs[name].snapshot for name, key in members_keys.items()},
+    )
+    # A partial provider would remove the missing resources from the registry.
+    if failures > 0:
+        raise Exception(
+            f"Failed to retrieve {failures} of {len(work_items)} projects details "
+            f"on provider '{os_conf.name}'"
+        )
+    regions = [merge_region(i, details[i.name]) for i in regions]
 
-    # Filter on IDPs and user groups with SLAs
-    # belonging to at least one project
-    for idp in trust_idps:
-        user_groups = []
-        for user_group in idp.user_groups:
-            for sla in user_group.slas:
-                if len(sla.projects) == 1:
-                    project = sla.projects[0]
-                    new_sla = SLACreateExtended(**sla.dict(), project=project)
-                    new_group = UserGroupCreateExtended(
-                        **user_group.dict(), sla=new_sla
-                    )
-                    user_groups.append(new_group)
-        idp.user_groups = user_groups
-    identity_providers = list(filter(lambda idp: len(idp.user_groups) > 0, trust_idps))
+    identity_providers = get_identity_providers(
+        site_config=site_config, accesses=accesses, sla_projects=sla_projects
+    )
 
     # Remove from flavors and images' projects the ones
     # that have not been imported in the Federation Registry
-    projects_uuid = [i.uuid for i in projects]
+    projects_uuid = set(projects)
     for region in regions:
         for service in region.compute_services:
             for flavor in service.flavors:
@@ -438,6 +829,6 @@ def get_provider(
         support_emails=os_conf.support_emails,
         status=os_conf.status,
         identity_providers=identity_providers,
-        projects=projects,
+        projects=list(projects.values()),
         regions=regions,
     )
@@ -0,0 +1,69 @@
+from threading import Lock
+from typing import Dict, Tuple
+
+from keystoneauth1.identity.v3 import OidcAccessToken
+from keystoneauth1.session import Session
+from logger import logger
+from openstack.connection import Connection
+
+
+class SessionCache:
+    """Keystone sessions shared by all the regions of the same project.
+
+    Sessions are keyed by (auth_url, identity provider, project). A project scoped
+    token is valid in every region, so the federated token exchange and the
+    catalog fetch happen once per project. keystoneauth renews the token when it
+    is about to expire; a session is rebuilt when the OIDC access token changes.
+    """
+
+    def __init__(self, *, timeout: float) -> None:
+        self.timeout = timeout
+        self._lock = Lock()
+        self._sessions: Dict[Tuple[str, str, str], Tuple[str, Session]] = {}
+
+    def get_session(
+        self,
+        *,
+        auth_url: str,
+        identity_provider: str,
+        protocol: str,
+        access_token: str,
+        project_id: str,
+    ) -> Session:
+        """Return the cached project scoped session, creating it if needed."""
+        key = (auth_url, identity_provider, project_id)
+        with self._lock:
+            cached = self._sessions.get(key)
+            if cached is not None:
+                if cached[0] == access_token:
+                    return cached[1]
+                # Release the pooled connections of the replaced session.
+                cached[1].session.close()
+            logger.debug(f"Creating keystone session for {key}")
+            auth = OidcAccessToken(
+                auth_url=auth_url,
+                identity_provider=identity_provider,
+                protocol=protocol,
+                access_token=access_token,
+                project_id=project_id,
+            )
+            session = Session(auth=auth, timeout=self.timeout)
+            self._sessions[key] = (access_token, session)
+        return session
+
+    def connect(self, *, region_name: str, **kwargs: str) -> Connection:
+        """Return a region specific connection built on the project session.
+
+        The first connection of a project performs the token exchange; the
+        following ones reuse the cached token and catalog.
+        """
+        session = self.get_session(**kwargs)
+        session.get_token()
+        return Connection(session=session, region_name=region_name)
+
+    def clear(self) -> None:
+        """Close and forget all the cached sessions."""
+        with self._lock:
+            for _, session in self._sessions.values():
+                session.session.close()
+            self._sessions.clear()
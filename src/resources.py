@@ -0,0 +1,152 @@
+import json
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from state import ItemState, compute_digest
+
+# Sub-resource lists of each service type: (service field, URLs attribute).
+RESOURCE_FIELDS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "block_storage_services": (("quotas", "block_storage_quotas"),),
+    "compute_services": (
+        ("flavors", "flavors"),
+        ("images", "images"),
+        ("quotas", "compute_quotas"),
+    ),
+    "network_services": (("networks", "networks"), ("quotas", "network_quotas")),
+}
+RESOURCE_TYPES = {
+    "block_storage_quotas": "Block Storage Quota",
+    "compute_quotas": "Compute Quota",
+    "flavors": "Flavor",
+    "images": "Image",
+    "network_quotas": "Network Quota",
+    "networks": "Network",
+}
+# Relationships with projects, not applied by the sub-resource endpoints.
+LINK_FIELDS = ("project", "projects")
+
+
+class Resource(NamedTuple):
+    kind: str
+    name: str
+    data: Dict[str, Any]
+
+
+class ResourceIndex(NamedTuple):
+    """Hashes of the base provider and of each sub-resource, keyed by identity."""
+
+    base: str
+    fingerprints: Dict[str, str]
+    resources: Dict[str, Resource]
+
+
+class ResourceChanges(NamedTuple):
+    updated: List[str]
+    removed: List[str]
+
+
+def get_resource_key(
+    *, kind: str, region: str, endpoint: str, entity: Dict[str, Any]
+) -> str:
+    """Return the identity of a sub-resource within its provider.
+
+    Entities are identified by their OpenStack UUID, quotas by their project.
+    """
+    if kind.endswith("quotas"):
+        project = entity["project"]
+        # Registry records nest the project.
+        if isinstance(project, dict):
+            project = project["uuid"]
+        entity_id = [project, entity.get("per_user", False), entity.get("usage", False)]
+    else:
+        entity_id = [entity["uuid"]]
+    return json.dumps([kind, region, endpoint, *entity_id])
+
+
+def iter_resource_lists(
+    data: Dict[str, Any],
+) -> Iterator[Tuple[str, str, Dict[str, Any], str, str]]:
+    """Yield region name, service endpoint, service and field of each sub-resource
+    list of a provider.
+    """
+    for region in data.get("regions", []):
+        for service_field, fields in RESOURCE_FIELDS.items():
+            for service in region.get(service_field, []):
+                for field, kind in fields:
+                    yield region["name"], service["endpoint"], service, field, kind
+
+
+def index_resources(data: Dict[str, Any]) -> ResourceIndex:
+    """Split the JSON encoded provider in its base data and its sub-resources."""
+    # Copy the services, which lose their sub-resources in the base data.
+    data = {
+        **data,
+        "regions": [
+            {
+                **region,
+                **{f: [dict(i) for i in region.get(f, [])] for f in RESOURCE_FIELDS},
+            }
+            for region in data.get("regions", [])
+        ],
+    }
+    fingerprints: Dict[str, str] = {}
+    resources: Dict[str, Resource] = {}
+    for region, endpoint, service, field, kind in iter_resource_lists(data):
+        for entity in service.pop(field, []):
+            key = get_resource_key(
+                kind=kind, region=region, endpoint=endpoint, entity=entity
+            )
+            links = {k: v for k, v in entity.items() if k in LINK_FIELDS}
+            attrs = {k: v for k, v in entity.items() if k not in LINK_FIELDS}
+            fingerprints[key] = f"{compute_digest(links)}:{compute_digest(attrs)}"
+            resources[key] = Resource(
+                kind=kind, name=entity.get("name", key), data=attrs
+            )
+    return ResourceIndex(
+        base=compute_digest(data), fingerprints=fingerprints, resources=resources
+    )
+
+
+def index_registry_resources(data: Dict[str, Any]) -> Dict[str, str]:
+    """Return the registry uid of each sub-resource of a provider record."""
+    uids = {}
+    for region, endpoint, service, field, kind in iter_resource_lists(data):
+        for entity in service.get(field, []):
+            key = get_resource_key(
+                kind=kind, region=region, endpoint=endpoint, entity=entity
+            )
+            uids[key] = entity["uid"]
+    return uids
+
+
+def diff_resources(
+    previous: Optional[ItemState], *, uid: str, index: ResourceIndex
+) -> Optional[ResourceChanges]:
+    """Return the sub-resources to update or remove since the last push.
+
+    Return None when the change can't be applied through the sub-resource
+    endpoints: the base provider or a relationship changed, a sub-resource was
+    added or the previous push is unknown.
+    """
+    if previous is None or previous.uid != uid or previous.base != index.base:
+        return None
+    updated = []
+    for key, fingerprint in index.fingerprints.items():
+        old = previous.resources.get(key)
+        if old is None:
+            return None
+        if old != fingerprint:
+            old_links, _ = old.split(":")
+            links, _ = fingerprint.split(":")
+            if old_links != links:
+                return None
+            updated.append(key)
+    removed = [k for k in previous.resources if k not in index.fingerprints]
+    return ResourceChanges(updated=updated, removed=removed)
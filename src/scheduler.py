@@ -0,0 +1,360 @@
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from keystoneauth1 import exceptions as ks_exceptions
+from logger import logger
+from metrics import get_call_times
+
+T = TypeVar("T")
+
+# Absolute deadline, in event loop time, of the calls scheduled by the current task.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+
+# Latencies are sampled per site and function.
+LatencyKey = Tuple[str, str]
+
+
+class DeadlineExceededError(asyncio.TimeoutError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[None]:
+    """Limit the calls scheduled in this context to a time budget.
+
+    Tasks created in the context inherit the budget. Nested budgets cannot extend
+    the enclosing one.
+    """
+    current = _deadline.get()
+    new = None if seconds is None else asyncio.get_running_loop().time() + seconds
+    if new is None or (current is not None and current < new):
+        new = current
+    token = _deadline.set(new)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+async def with_deadline(seconds: Optional[float], aw: Awaitable[T]) -> T:
+    """Await within a time budget."""
+    with deadline(seconds):
+        return await aw
+
+
+def get_remaining() -> Optional[float]:
+    """Return the seconds left before the current deadline, if any."""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return current - asyncio.get_running_loop().time()
+
+
+def get_name(func: Callable[..., Any]) -> str:
+    """Return the name of a scheduled function."""
+    return getattr(func, "__qualname__", type(func).__name__)
+
+
+def is_transient(e: Exception) -> bool:
+    """Return True if the error denotes an unreachable or overloaded site."""
+    if isinstance(
+        e,
+        (
+            asyncio.TimeoutError,
+            ConnectionError,
+            ks_exceptions.ConnectionError,
+            ks_exceptions.RetriableConnectionFailure,
+        ),
+    ):
+        return True
+    status = getattr(e, "status_code", None) or getattr(e, "http_status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+class CircuitBreaker:
+    """Fail fast on a site after too many consecutive transient failures.
+
+    Once the reset timeout expires, calls go through again: a single further
+    failure opens the circuit again, a success closes it.
+    """
+
+    def __init__(self, *, threshold: int, reset_timeout: float) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.open_until = 0.0
+
+    def check(self, site: str) -> None:
+        """Raise if the circuit of the site is open."""
+        if time.monotonic() < self.open_until:
+            raise CircuitOpenError(f"Site {site} is unavailable")
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self, site: str) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if time.monotonic() >= self.open_until:
+                logger.warning(f"Too many failures on site {site}: circuit open")
+            self.open_until = time.monotonic() + self.reset_timeout
+
+
+class Scheduler:
+    """Run blocking calls of a whole run with a global and a per-site cap.
+
+    Calls are bounded by the deadline of the calling task and fail fast on sites
+    whose circuit is open. Idempotent reads are retried with jittered backoff and
+    hedged when slower than the given latency percentile of the same function on
+    their site.
+
+    Must be created inside the running event loop.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_workers: int,
+        max_workers_per_site: int,
+        max_retries: int = 0,
+        backoff: float = 0.5,
+        backoff_max: float = 10,
+        breaker_threshold: int = 5,
+        breaker_reset_timeout: float = 60,
+        hedge_percentile: Optional[float] = None,
+    ) -> None:
+        self.max_workers_per_site = max_workers_per_site
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.hedge_percentile = hedge_percentile
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._global = asyncio.Semaphore(max_workers)
+        self._sites: Dict[str, asyncio.Semaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[LatencyKey, Deque[float]] = {}
+
+    def _site(self, site: str) -> asyncio.Semaphore:
+        sem = self._sites.get(site)
+        if sem is None:
+            sem = asyncio.Semaphore(self.max_workers_per_site)
+            self._sites[site] = sem
+        return sem
+
+    def _breaker(self, site: str) -> CircuitBreaker:
+        breaker = self._breakers.get(site)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                threshold=self.breaker_threshold,
+                reset_timeout=self.breaker_reset_timeout,
+            )
+            self._breakers[site] = breaker
+        return breaker
+
+    def _hedge_delay(self, key: LatencyKey) -> Optional[float]:
+        latencies = self._latencies.get(key)
+        if (
+            self.hedge_percentile is None
+            or latencies is None
+            or len(latencies) < HEDGE_MIN_SAMPLES
+        ):
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(int(len(ordered) * self.hedge_percentile), len(ordered) - 1)]
+
+    async def _submit(self, site: str, call: Callable[[], T]) -> "asyncio.Future[T]":
+        """Start the call in the pool once both caps allow it.
+
+        The site slot is taken first so that a saturated site does not hold global
+        slots while waiting. Slots are released when the thread returns, even if
+        the caller stopped waiting for it.
+        """
+        loop = asyncio.get_running_loop()
+        times = get_call_times()
+        queued = loop.time()
+        site_sem = self._site(site)
+        await site_sem.acquire()
+        try:
+            await self._global.acquire()
+        except BaseException:
+            site_sem.release()
+            raise
+        if times is not None:
+            times.waiting.append(loop.time() - queued)
+
+        def timed_call() -> T:
+            start = time.monotonic()
+            try:
+                return call()
+            finally:
+                if times is not None:
+                    times.busy.append(time.monotonic() - start)
+
+        def release() -> None:
+            self._global.release()
+            site_sem.release()
+
+        def on_done(future: "Future[T]") -> None:
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                # The event loop of an abandoned call is already closed.
+                pass
+
+        try:
+            future = self.executor.submit(timed_call)
+        except BaseException:
+            release()
+            raise
+        future.add_done_callback(on_done)
+        return asyncio.wrap_future(future)
+
+    async def _execute(
+        self, site: str, name: str, call: Callable[[], T], *, hedge: bool
+    ) -> T:
+        """Execute the call in the pool, hedged if slower than usual.
+
+        The hedged attempt needs a slot of its own: it is skipped when none is
+        free.
+        """
+        loop = asyncio.get_running_loop()
+        attempts = [await self._submit(site, call)]
+        start = loop.time()
+        key = (site, name)
+        delay = self._hedge_delay(key) if hedge else None
+        if delay is not None:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if len(done) == 0 and not (
+                self._site(site).locked() or self._global.locked()
+            ):
+                logger.debug(f"Hedging {name} slower than {delay:.3f}s on {site}")
+                attempts.append(await self._submit(site, call))
+        for attempt in attempts:
+            # Results of the discarded attempt are not needed.
+            attempt.add_done_callback(lambda f: f.cancelled() or f.exception())
+        # Return the first successful attempt, or the last failure.
+        pending = set(attempts)
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for attempt in done:
+                if attempt.exception() is None:
+                    if hedge:
+                        latencies = self._latencies.setdefault(
+                            key, deque(maxlen=LATENCY_SAMPLES)
+                        )
+                        latencies.append(loop.time() - start)
+                    return attempt.result()
+            if len(pending) == 0:
+                raise done.pop().exception()
+
+    async def _backoff(self, site: str, retries: int, e: Exception) -> bool:
+        """Wait before a retry, unless the deadline expires before it.
+
+        Return True if the call can be retried.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2**retries))
+        remaining = get_remaining()
+        if remaining is not None and delay >= remaining:
+            return False
+        logger.warning(f"Retrying call on {site} in {delay:.2f}s: {e!r}")
+        times = get_call_times()
+        if times is not None:
+            times.waiting.append(delay)
+        await asyncio.sleep(delay)
+        return True
+
+    async def _call(
+        self, site: str, name: str, call: Callable[[], T], *, idempotent: bool
+    ) -> T:
+        breaker = self._breaker(site)
+        retries = 0
+        while True:
+            breaker.check(site)
+            remaining = get_remaining()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceededError(f"Deadline exceeded on {site}")
+                try:
+                    return_value = await asyncio.wait_for(
+                        self._execute(site, name, call, hedge=idempotent), remaining
+                    )
+                except asyncio.TimeoutError as e:
+                    left = get_remaining()
+                    if left is not None and left <= 0:
+                        raise DeadlineExceededError(
+                            f"Deadline exceeded on {site}"
+                        ) from e
+                    raise
+            except DeadlineExceededError:
+                # The budget of the caller, not the site, ran out.
+                raise
+            except Exception as e:
+                if not is_transient(e):
+                    breaker.record_success()
+                    raise
+                breaker.record_failure(site)
+                if (
+                    not idempotent
+                    or retries >= self.max_retries
+                    or not await self._backoff(site, retries, e)
+                ):
+                    raise
+                retries += 1
+                continue
+            breaker.record_success()
+            return return_value
+
+    async def run(
+        self, site: str, func: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        """Execute a blocking function in the pool, once."""
+        return await self._call(
+            site, get_name(func), partial(func, *args, **kwargs), idempotent=False
+        )
+
+    async def read(
+        self, site: str, func: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        """Execute an idempotent blocking function in the pool.
+
+        Transient failures are retried and calls slower than usual for the same
+        function on the site are hedged.
+        """
+        return await self._call(
+            site, get_name(func), partial(func, *args, **kwargs), idempotent=True
+        )
+
+    def shutdown(self) -> None:
+        """Release the worker threads.
+
+        Calls abandoned after their deadline are not waited for.
+        """
+        self.executor.shutdown(wait=False)
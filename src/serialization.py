@@ -0,0 +1,84 @@
+import gzip
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Optional
+from uuid import UUID
+
+from logger import logger
+from pydantic import BaseModel
+
+# Faster encoders and compressors are used when installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTENT_ENCODINGS = ("gzip", "zstd")
+
+
+def encode_default(obj: Any) -> Any:
+    """Return a JSON serializable representation of objects unknown to the encoder.
+
+    Models become a shallow dict keyed by field alias, as `jsonable_encoder` does:
+    nested values are converted by the encoder while it writes them, without
+    building an intermediate copy of the whole tree. Models with custom
+    `json_encoders` are encoded by pydantic, which applies them to every nested
+    value.
+    """
+    if isinstance(obj, BaseModel):
+        if obj.__config__.json_encoders:
+            return json.loads(obj.json(by_alias=True))
+        if "__root__" in obj.__fields__:
+            return obj.__root__
+        return {f.alias: getattr(obj, k) for k, f in obj.__fields__.items()}
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, UUID):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data: Any) -> bytes:
+    """Encode data, models included, to a JSON document."""
+    if orjson is not None:
+        return orjson.dumps(data, default=encode_default)
+    return json.dumps(data, default=encode_default, separators=(",", ":")).encode()
+
+
+def loads(data: bytes) -> Any:
+    """Decode a JSON document."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def to_jsonable(data: Any) -> Any:
+    """Return data, models included, as JSON compatible builtin types."""
+    return loads(dumps(data))
+
+
+def get_content_encoding(encoding: Optional[str]) -> Optional[str]:
+    """Return the usable request body encoding closest to the requested one."""
+    if encoding == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed. Compressing requests with gzip")
+        return "gzip"
+    return encoding
+
+
+def compress(body: bytes, *, encoding: str) -> bytes:
+    """Compress a request body with the given content encoding."""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(body)
+    return gzip.compress(body, compresslevel=6)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import tempfile
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from logger import logger
+from pydantic import BaseModel, Field
+
+
+def canonical_dumps(data: Any) -> str:
+    """Return a JSON dump of data independent from keys and items order.
+
+    Concurrent harvesting does not guarantee the order of the listed entities,
+    so lists are sorted too. Each subtree is serialized once, bottom-up, and lists
+    are sorted on the dumps of their items.
+    """
+    if isinstance(data, dict):
+        items = (f"{json.dumps(k)}:{canonical_dumps(v)}" for k, v in data.items())
+        return "{" + ",".join(sorted(items)) + "}"
+    if isinstance(data, list):
+        return "[" + ",".join(sorted(canonical_dumps(i) for i in data)) + "]"
+    return json.dumps(data)
+
+
+def compute_digest(data: Any) -> str:
+    """Return a stable hash of JSON compatible data."""
+    return hashlib.sha256(canonical_dumps(data).encode()).hexdigest()
+
+
+class ItemState(BaseModel):
+    uid: str = Field(description="Item unique ID in the Federation Registry")
+    fingerprint: str = Field(description="Hash of the last successfully pushed data")
+    base: Optional[str] = Field(
+        default=None, description="Hash of the pushed data without sub-resources"
+    )
+    resources: Dict[str, str] = Field(
+        default_factory=dict, description="Hash of each pushed sub-resource"
+    )
+
+
+class StateStore:
+    """Local record of the last successful push of each item, keyed by name.
+
+    Thread safe: concurrent syncs must share the same instance, or their saves
+    overwrite each other's items.
+    """
+
+    def __init__(self, *, path: str) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._save_lock = Lock()
+        self._items: Dict[str, ItemState] = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self._items = {k: ItemState(**v) for k, v in json.load(f).items()}
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Ignoring corrupted state file {path}: {e!r}")
+
+    def get(self, name: str) -> Optional[ItemState]:
+        """Return the stored state of the given item, if any."""
+        with self._lock:
+            return self._items.get(name)
+
+    def set(
+        self,
+        name: str,
+        *,
+        uid: str,
+        fingerprint: str,
+        base: Optional[str] = None,
+        resources: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Record a successful push."""
+        with self._lock:
+            self._items[name] = ItemState(
+                uid=uid,
+                fingerprint=fingerprint,
+                base=base,
+                resources={} if resources is None else resources,
+            )
+
+    def discard(self, name: str) -> None:
+        """Forget an item."""
+        with self._lock:
+            self._items.pop(name, None)
+
+    def is_unchanged(self, name: str, *, uid: str, fingerprint: str) -> bool:
+        """Return True if the item was already pushed with the same content."""
+        state = self.get(name)
+        return (
+            state is not None and state.uid == uid and state.fingerprint == fingerprint
+        )
+
+    def save(self) -> None:
+        """Atomically write the state on disk.
+
+        Saves are serialized, so that an older state never replaces a newer one.
+        """
+        with self._save_lock:
+            with self._lock:
+                data = {k: v.dict() for k, v in self._items.items()}
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=".state.", delete=False
+            ) as f:
+                json.dump(data, f)
+            os.replace(f.name, self.path)
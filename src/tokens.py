@@ -0,0 +1,97 @@
+import base64
+import json
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional
+
+from logger import logger
+from metrics import metrics
+
+if TYPE_CHECKING:
+    from models.provider import SiteConfig
+
+
+def generate_token(issuer: str) -> str:
+    """Generate an access token for the given issuer through oidc-agent."""
+    token_cmd = subprocess.run(
+        [
+            "docker",
+            "exec",
+            "federation-registry_devcontainer-oidc-agent-1",
+            "oidc-token",
+            issuer,
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return token_cmd.stdout.strip("\n")
+
+
+def get_expiration(token: str) -> Optional[float]:
+    """Return the expiration timestamp of a JWT, None for opaque tokens."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class CachedToken(NamedTuple):
+    token: str
+    expires_at: float
+
+
+class TokenProvider:
+    """Access tokens of the trusted IDPs, generated once per issuer.
+
+    Tokens are cached until shortly before their expiration, read from the JWT
+    or, for opaque tokens, assumed after a default lifetime. Tokens of different
+    issuers are generated concurrently.
+    """
+
+    def __init__(self, *, refresh_margin: float, default_lifetime: float) -> None:
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self._tokens: Dict[str, CachedToken] = {}
+        self._lock = Lock()
+        self._issuer_locks: Dict[str, Lock] = defaultdict(Lock)
+
+    def get_token(self, issuer: str) -> str:
+        """Return a token of the issuer valid at least for the refresh margin."""
+        with self._lock:
+            issuer_lock = self._issuer_locks[issuer]
+        # Concurrent requests for the same issuer wait for a single generation.
+        with issuer_lock:
+            cached = self._tokens.get(issuer)
+            if cached is not None and cached.expires_at - time.time() > (
+                self.refresh_margin
+            ):
+                return cached.token
+            logger.info(f"Generating access token for issuer {issuer}")
+            with metrics.timer("token_fetch"):
+                token = generate_token(issuer)
+            expires_at = get_expiration(token)
+            if expires_at is None:
+                expires_at = time.time() + self.default_lifetime
+            self._tokens[issuer] = CachedToken(token=token, expires_at=expires_at)
+            return token
+
+    def fill(self, configs: List["SiteConfig"]) -> None:
+        """Set or renew the tokens of trusted IDPs without a configured one."""
+        trusted_idps = [
+            trusted_idp
+            for config in configs
+            for trusted_idp in config.trusted_idps
+            if trusted_idp.needs_generated_token
+        ]
+        issuers = list({str(i.endpoint) for i in trusted_idps})
+        if len(issuers) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(issuers)) as pool:
+            tokens = dict(zip(issuers, pool.map(self.get_token, issuers)))
+        for trusted_idp in trusted_idps:
+            trusted_idp.set_generated_token(tokens[str(trusted_idp.endpoint)])
@@ -1,19 +1,47 @@
+import hashlib
+import json
 import os
-from typing import Dict, List, Tuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 import yaml
-from app.provider.schemas_extended import ProviderCreateExtended
-from crud import CRUD
+from config import get_settings
 from logger import logger
+from metrics import metrics
 from models.federation_registry import FederationRegistry, URLs
-from models.provider import SiteConfig
 
+# Use the libyaml based loader when available.
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
 
-def load_federation_registry_config(*, base_path: str = ".") -> SiteConfig:
+# Provider models, the HTTP client and the state store pull in the whole
+# Federation Registry schemas: they are imported only when needed.
+if TYPE_CHECKING:
+    from app.provider.schemas_extended import ProviderCreateExtended
+    from config_cache import ConfigCache
+    from crud import CRUD, RegistryItem
+    from models.provider import SiteConfig
+    from resources import ResourceChanges, ResourceIndex
+    from state import StateStore
+    from tokens import TokenProvider
+
+
+def load_federation_registry_config(*, base_path: str = ".") -> URLs:
     """Load Federation Registry configuration."""
     logger.info("Loading Federation Registry configuration")
     with open(os.path.join(base_path, ".federation-registry-config.yaml")) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
+        config = yaml.load(f, Loader=YAML_LOADER)
     config = FederationRegistry(**config)
     logger.debug(f"{config!r}")
 
@@ -25,18 +53,99 @@ def load_federation_registry_config(*, base_path: str = ".") -> SiteConfig:
     return urls
 
 
-def load_config(*, fname: str) -> SiteConfig:
-    """Load provider configuration from yaml file."""
+def list_config_files(*, base_path: str = ".") -> List[str]:
+    """Return the paths of the yaml files containing providers configurations."""
+    return [
+        os.path.join(base_path, i)
+        for i in sorted(os.listdir(base_path))
+        if i.endswith(".config.yaml")
+    ]
+
+
+@metrics.timer("config_load")
+def load_config(*, fname: str, cache: Optional["ConfigCache"] = None) -> "SiteConfig":
+    """Load provider configuration from yaml file.
+
+    When a cache is given, unchanged files skip parsing and validation. Missing
+    tokens are not generated: see TokenProvider.
+    """
+    from models.provider import SiteConfig
+
     logger.info(f"Loading provider configuration from {fname}")
-    with open(fname) as f:
-        config = yaml.load(f, Loader=yaml.FullLoader)
-        config = SiteConfig(**config)
+    with open(fname, "rb") as f:
+        content = f.read()
+    mtime = os.path.getmtime(fname)
+    digest = hashlib.sha256(content).hexdigest()
+    if cache is not None:
+        config = cache.load(fname, mtime=mtime, digest=digest)
+        if config is not None:
+            logger.info("Configuration loaded from cache")
+            return config
+
+    data = yaml.load(content, Loader=YAML_LOADER)
+    config = SiteConfig(**data)
+    if cache is not None:
+        try:
+            cache.store(fname, mtime=mtime, digest=digest, config=config)
+        except Exception as e:
+            logger.warning(f"Failed to cache configuration {fname}: {e!r}")
 
     logger.info("Configuration loaded")
     logger.debug(f"{config!r}")
     return config
 
 
+def get_config_cache() -> Optional["ConfigCache"]:
+    """Return the configurations cache, if enabled."""
+    from config_cache import ConfigCache
+
+    settings = get_settings()
+    if not settings.CONFIG_CACHE_DIR:
+        return None
+    return ConfigCache(path=settings.CONFIG_CACHE_DIR)
+
+
+def get_token_provider() -> "TokenProvider":
+    """Return a token provider configured from the settings."""
+    from tokens import TokenProvider
+
+    settings = get_settings()
+    return TokenProvider(
+        refresh_margin=settings.TOKEN_REFRESH_MARGIN,
+        default_lifetime=settings.TOKEN_DEFAULT_LIFETIME,
+    )
+
+
+def load_configs(
+    *, fnames: List[str], token_provider: Optional["TokenProvider"] = None
+) -> List["SiteConfig"]:
+    """Load the provider configurations of the given files.
+
+    Missing tokens are then generated, once per issuer.
+    """
+    cache = get_config_cache()
+    configs = [load_config(fname=i, cache=cache) for i in fnames]
+    if token_provider is None:
+        token_provider = get_token_provider()
+    token_provider.fill(configs)
+    return configs
+
+
+def is_owned(name: str) -> bool:
+    """Return True if the provider with the given name belongs to this replica.
+
+    Providers are assigned to replicas with a stable hash of their name, the same
+    on every replica and run.
+    """
+    settings = get_settings()
+    if settings.SHARD_COUNT == 1:
+        return True
+    digest = hashlib.sha256(name.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % settings.SHARD_COUNT == (
+        settings.SHARD_INDEX
+    )
+
+
 def get_read_write_headers(*, token: str) -> Tuple[Dict[str, str], Dict[str, str]]:
     """From an access token, create the read and write headers."""
     read_header = {"authorization": f"Bearer {token}"}
@@ -48,26 +157,322 @@ def get_read_write_headers(*, token: str) -> Tuple[Dict[str, str], Dict[str, str
     return (read_header, write_header)
 
 
-def update_database(
-    *, federation_registry_urls: URLs, items: List[ProviderCreateExtended], token: str
+class SyncResult(NamedTuple):
+    name: str
+    operation: str
+    error: Optional[Exception] = None
+
+
+def get_failures_summary(results: List[SyncResult]) -> Optional[str]:
+    """Describe the failed operations. Return None if all of them succeeded."""
+    failures = [i for i in results if i.error is not None]
+    if len(failures) == 0:
+        return None
+    return (
+        f"Failed {len(failures)} of {len(results)} Federation Registry operations: "
+        f"{', '.join(f'{i.operation} {i.name}' for i in failures)}"
+    )
+
+
+def run_operations(
+    *, name: str, operations: List[Tuple[str, Callable[[], Any]]]
+) -> List[SyncResult]:
+    """Execute in order the operations targeting the same item.
+
+    Stop at the first failure: the following operations depend on it.
+    """
+    results = []
+    for i, (operation, func) in enumerate(operations):
+        try:
+            func()
+        except Exception as e:
+            logger.error(f"Failed to {operation} {name}: {e!r}")
+            results.append(SyncResult(name=name, operation=operation, error=e))
+            for skipped, _ in operations[i + 1 :]:
+                results.append(
+                    SyncResult(
+                        name=name,
+                        operation=skipped,
+                        error=Exception(f"Skipped after failed {operation}"),
+                    )
+                )
+            break
+        results.append(SyncResult(name=name, operation=operation))
+    return results
+
+
+def set_item_state(
+    *,
+    state: "StateStore",
+    name: str,
+    uid: str,
+    fingerprint: str,
+    index: Optional["ResourceIndex"],
 ) -> None:
+    """Record the fingerprint of the item and, if given, of its sub-resources."""
+    if index is None:
+        state.set(name, uid=uid, fingerprint=fingerprint)
+    else:
+        state.set(
+            name,
+            uid=uid,
+            fingerprint=fingerprint,
+            base=index.base,
+            resources=index.fingerprints,
+        )
+
+
+def create_item(
+    *,
+    crud: "CRUD",
+    state: "StateStore",
+    item: "ProviderCreateExtended",
+    fingerprint: str,
+    index: Optional["ResourceIndex"] = None,
+) -> None:
+    """Create the item and record its fingerprint."""
+    db_item = crud.create(data=item)
+    set_item_state(
+        state=state,
+        name=item.name,
+        uid=str(db_item.uid),
+        fingerprint=fingerprint,
+        index=index,
+    )
+
+
+def update_item(
+    *,
+    crud: "CRUD",
+    state: "StateStore",
+    item: "ProviderCreateExtended",
+    db_item: "RegistryItem",
+    fingerprint: str,
+    index: Optional["ResourceIndex"] = None,
+) -> None:
+    """Update the item and record its fingerprint."""
+    crud.update(new_data=item, old_data=db_item)
+    set_item_state(
+        state=state,
+        name=item.name,
+        uid=db_item.uid,
+        fingerprint=fingerprint,
+        index=index,
+    )
+
+
+def update_item_resources(
+    *,
+    crud: "CRUD",
+    urls: URLs,
+    state: "StateStore",
+    item: "ProviderCreateExtended",
+    db_item: "RegistryItem",
+    fingerprint: str,
+    index: "ResourceIndex",
+    changes: "ResourceChanges",
+) -> None:
+    """Update and remove only the changed sub-resources of the item.
+
+    Update the whole item when the registry record does not contain all of them.
+    """
+    from crud import ResourceCRUD
+    from resources import RESOURCE_TYPES, index_registry_resources
+
+    # Nothing to send: record the new fingerprint without reading the item.
+    if len(changes.updated) == 0 and len(changes.removed) == 0:
+        set_item_state(
+            state=state,
+            name=item.name,
+            uid=db_item.uid,
+            fingerprint=fingerprint,
+            index=index,
+        )
+        return
+
+    uids = index_registry_resources(crud.read_one(uid=db_item.uid).data)
+    missing = [k for k in (*changes.updated, *changes.removed) if k not in uids]
+    if len(missing) > 0:
+        logger.warning(
+            f"{len(missing)} sub-resources of {crud.type}={item.name} not found in "
+            "the Federation Registry. Updating the whole item"
+        )
+        update_item(
+            crud=crud,
+            state=state,
+            item=item,
+            db_item=db_item,
+            fingerprint=fingerprint,
+            index=index,
+        )
+        return
+
+    cruds: Dict[str, ResourceCRUD] = {}
+
+    def get_crud(kind: str) -> ResourceCRUD:
+        if kind not in cruds:
+            cruds[kind] = ResourceCRUD(
+                type=RESOURCE_TYPES[kind],
+                url=getattr(urls, kind),
+                read_headers=crud.read_headers,
+                write_headers=crud.write_headers,
+                session=crud.session,
+            )
+        return cruds[kind]
+
+    for key in changes.updated:
+        resource = index.resources[key]
+        get_crud(resource.kind).update_one(
+            uid=uids[key], name=resource.name, data=resource.data
+        )
+    for key in changes.removed:
+        kind = json.loads(key)[0]
+        get_crud(kind).remove_one(uid=uids[key], name=key)
+    set_item_state(
+        state=state,
+        name=item.name,
+        uid=db_item.uid,
+        fingerprint=fingerprint,
+        index=index,
+    )
+
+
+def remove_item(*, crud: "CRUD", state: "StateStore", db_item: "RegistryItem") -> None:
+    """Remove the item and forget its fingerprint."""
+    crud.remove(item=db_item)
+    state.discard(db_item.name)
+
+
+def update_database(
+    *,
+    federation_registry_urls: URLs,
+    items: List["ProviderCreateExtended"],
+    token: str,
+    remove_missing: bool = True,
+    protected: Collection[str] = (),
+    state: Optional["StateStore"] = None,
+) -> List[SyncResult]:
     """Use the read and write headers to create, update or remove providers from the
     Federation Registry.
+
+    Operations on different providers are sent concurrently, with a bounded number
+    of requests in flight. Operations on the same provider name keep their order.
+    Return the result of each operation instead of raising on the first failure.
+
+    Providers whose fingerprint matches the last successful push, stored in the
+    local state file, are not sent again. Concurrent calls must share the given
+    state store. When remove_missing is True, registry providers not in items are
+    removed, if owned by this replica and not protected.
+
+    With the "resources" sync mode, when only flavors, images, networks or quotas
+    of a provider were updated or removed since the last push, only those are
+    sent, through their own endpoints.
     """
+    from crud import CRUD, compute_record_fingerprint
+    from resources import diff_resources, index_resources
+    from serialization import to_jsonable
+    from state import StateStore, compute_digest
+
+    settings = get_settings()
+    if state is None:
+        state = StateStore(path=settings.STATE_FILE)
+    resources_sync = settings.REGISTRY_SYNC_MODE == "resources"
     read_header, write_header = get_read_write_headers(token=token)
-    crud = CRUD(
+    with CRUD(
         url=federation_registry_urls.providers,
         read_headers=read_header,
         write_headers=write_header,
-    )
+    ) as crud:
+        logger.info("Retrieving data from Federation Registry")
+        # Only identifiers are needed to choose between create, update and remove.
+        db_items = {
+            db_item.name: db_item
+            for db_item in crud.read(short=True, page_size=settings.REGISTRY_PAGE_SIZE)
+        }
+
+        operations: Dict[str, List[Tuple[str, Callable[[], Any]]]] = defaultdict(list)
+        for item in items:
+            # Encoded once, for the fingerprint and the sub-resources index.
+            data = to_jsonable(item)
+            fingerprint = compute_digest(data)
+            db_item = db_items.pop(item.name, None)
+            # Base attributes edited in the registry since the last push.
+            edited = (
+                db_item is not None
+                and db_item.fingerprint != compute_record_fingerprint(data)
+            )
+            if (
+                db_item is not None
+                and not edited
+                and state.is_unchanged(
+                    item.name, uid=db_item.uid, fingerprint=fingerprint
+                )
+            ):
+                logger.info(f"{crud.type}={item.name} unchanged since last push")
+                continue
+            index = index_resources(data) if resources_sync else None
+            if db_item is None:
+                func = partial(
+                    create_item,
+                    crud=crud,
+                    state=state,
+                    item=item,
+                    fingerprint=fingerprint,
+                    index=index,
+                )
+                operations[item.name].append(("create", func))
+                continue
+            changes = (
+                None
+                if index is None or edited
+                else diff_resources(state.get(item.name), uid=db_item.uid, index=index)
+            )
+            if changes is None:
+                func = partial(
+                    update_item,
+                    crud=crud,
+                    state=state,
+                    item=item,
+                    db_item=db_item,
+                    fingerprint=fingerprint,
+                    index=index,
+                )
+            else:
+                logger.info(
+                    f"Updating {len(changes.updated)} and removing "
+                    f"{len(changes.removed)} sub-resources of {crud.type}={item.name}"
+                )
+                func = partial(
+                    update_item_resources,
+                    crud=crud,
+                    urls=federation_registry_urls,
+                    state=state,
+                    item=item,
+                    db_item=db_item,
+                    fingerprint=fingerprint,
+                    index=index,
+                    changes=changes,
+                )
+            operations[item.name].append(("update", func))
+        if remove_missing:
+            for db_item in db_items.values():
+                # Providers of other replicas are not removed.
+                if not is_owned(db_item.name) or db_item.name in protected:
+                    continue
+                func = partial(remove_item, crud=crud, state=state, db_item=db_item)
+                operations[db_item.name].append(("remove", func))
 
-    logger.info("Retrieving data from Federation Registry")
-    db_items = {db_item.name: db_item for db_item in crud.read(with_conn=True)}
-    for item in items:
-        db_item = db_items.pop(item.name, None)
-        if db_item is None:
-            crud.create(data=item)
-        else:
-            crud.update(new_data=item, old_data=db_item)
-    for db_item in db_items.values():
-        crud.remove(item=db_item)
+        with ThreadPoolExecutor(max_workers=settings.REGISTRY_MAX_IN_FLIGHT) as pool:
+            futures = [
+                pool.submit(run_operations, name=name, operations=ops)
+                for name, ops in operations.items()
+            ]
+            results = [result for future in futures for result in future.result()]
+    state.save()
+
+    failures = [i for i in results if i.error is not None]
+    logger.info(
+        f"Federation Registry updated: {len(results) - len(failures)} operations "
+        f"succeeded, {len(failures)} failed"
+    )
+    return results
@@ -0,0 +1,86 @@
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+import pytest
+from crud import CRUD, RegistryItem
+
+
+def get_items(count: int) -> List[RegistryItem]:
+    return [
+        RegistryItem(name=f"p{i}", uid=str(UUID(int=i + 1)), fingerprint="", data={})
+        for i in range(count)
+    ]
+
+
+class FakeRegistry:
+    """Serve the sorted pages of a provider list and record the requests."""
+
+    def __init__(
+        self,
+        items: List[RegistryItem],
+        *,
+        paginate: bool = True,
+        on_read: Optional[Callable[[List[RegistryItem]], None]] = None,
+    ) -> None:
+        self.items = items
+        self.paginate = paginate
+        self.on_read = on_read
+        self.requests: List[Dict[str, Any]] = []
+
+    def read_page(self, params: Dict[str, Any]) -> List[RegistryItem]:
+        self.requests.append(dict(params))
+        items = sorted(self.items, key=lambda i: i.uid)
+        if self.paginate and "page" in params:
+            start = params["page"] * params["size"]
+            items = items[start : start + params["size"]]
+        if self.on_read is not None:
+            self.on_read(self.items)
+        return items
+
+
+@pytest.fixture
+def crud() -> CRUD:
+    return CRUD(
+        url="https://registry.example.org/providers/", read_headers={}, write_headers={}
+    )
+
+
+def test_read_without_pages(crud: CRUD, monkeypatch: pytest.MonkeyPatch) -> None:
+    registry = FakeRegistry(get_items(3))
+    monkeypatch.setattr(crud, "_read_page", registry.read_page)
+    assert list(crud.read()) == registry.items
+    assert registry.requests == [{"with_conn": False, "short": False}]
+
+
+@pytest.mark.parametrize("count", [0, 3, 4, 5])
+def test_read_pages(crud: CRUD, monkeypatch: pytest.MonkeyPatch, count: int) -> None:
+    registry = FakeRegistry(get_items(count))
+    monkeypatch.setattr(crud, "_read_page", registry.read_page)
+    assert list(crud.read(short=True, page_size=2)) == registry.items
+    assert [r["page"] for r in registry.requests] == list(range(count // 2 + 1))
+    assert all(r["sort"] == "uid" and r["size"] == 2 for r in registry.requests)
+    assert all(r["short"] for r in registry.requests)
+
+
+def test_read_registry_ignoring_pages(
+    crud: CRUD, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    registry = FakeRegistry(get_items(3), paginate=False)
+    monkeypatch.setattr(crud, "_read_page", registry.read_page)
+    assert list(crud.read(page_size=2)) == registry.items
+    assert len(registry.requests) == 2
+
+
+def test_read_changed_list(crud: CRUD, monkeypatch: pytest.MonkeyPatch) -> None:
+    # An item sorted first is added after the first page: the next page starts
+    # with the last item of the first one.
+    def add_item(items: List[RegistryItem]) -> None:
+        if len(items) == 4:
+            items.append(
+                RegistryItem(name="new", uid=str(UUID(int=0)), fingerprint="", data={})
+            )
+
+    registry = FakeRegistry(get_items(4), on_read=add_item)
+    monkeypatch.setattr(crud, "_read_page", registry.read_page)
+    with pytest.raises(Exception, match="changed while reading"):
+        list(crud.read(page_size=2))
@@ -0,0 +1,13 @@
+from importtime import main, measure
+
+# Modules imported only when there is something to harvest or to sync.
+HEAVY_MODULES = ("openstack", "keystoneauth1", "app", "fastapi")
+
+
+def test_main_import_time_budget() -> None:
+    assert main(["--module", "main", "--budget-ms", "300", "--repeat", "3"]) == 0
+
+
+def test_main_lazy_imports() -> None:
+    _, self_times = measure(module="main")
+    assert not [m for m in self_times if m.split(".")[0] in HEAVY_MODULES]
@@ -0,0 +1,86 @@
+from typing import Any, Dict, List
+
+from resources import ResourceChanges, diff_resources, get_resource_key, index_resources
+from state import ItemState
+
+UID = "0b4d3d5b-5f0e-4b5e-9d3a-4a3f5e3f0c2a"
+ENDPOINT = "https://compute.example.org"
+
+
+def get_provider(flavors: List[Dict[str, Any]], **kwargs: Any) -> Dict[str, Any]:
+    return {
+        "name": "provider",
+        "type": "openstack",
+        "regions": [
+            {
+                "name": "RegionOne",
+                "compute_services": [{"endpoint": ENDPOINT, "flavors": flavors}],
+            }
+        ],
+        **kwargs,
+    }
+
+
+def get_flavor(uuid: str, **kwargs: Any) -> Dict[str, Any]:
+    return {"uuid": uuid, "name": f"flavor-{uuid}", "vcpus": 1, **kwargs}
+
+
+def get_key(uuid: str) -> str:
+    return get_resource_key(
+        kind="flavors", region="RegionOne", endpoint=ENDPOINT, entity={"uuid": uuid}
+    )
+
+
+def get_state(data: Dict[str, Any]) -> ItemState:
+    """Return the state recorded after pushing data."""
+    index = index_resources(data)
+    return ItemState(
+        uid=UID, fingerprint="", base=index.base, resources=index.fingerprints
+    )
+
+
+def test_unknown_previous_push() -> None:
+    index = index_resources(get_provider([get_flavor("a")]))
+    assert diff_resources(None, uid=UID, index=index) is None
+    previous = get_state(get_provider([get_flavor("a")]))
+    previous.base = None
+    assert diff_resources(previous, uid=UID, index=index) is None
+
+
+def test_other_registry_item() -> None:
+    previous = get_state(get_provider([get_flavor("a")]))
+    index = index_resources(get_provider([get_flavor("a")]))
+    assert diff_resources(previous, uid="other", index=index) is None
+
+
+def test_no_changes() -> None:
+    previous = get_state(get_provider([get_flavor("a"), get_flavor("b")]))
+    index = index_resources(get_provider([get_flavor("b"), get_flavor("a")]))
+    changes = diff_resources(previous, uid=UID, index=index)
+    assert changes == ResourceChanges(updated=[], removed=[])
+
+
+def test_updated_and_removed_resources() -> None:
+    previous = get_state(get_provider([get_flavor("a"), get_flavor("b")]))
+    index = index_resources(get_provider([get_flavor("a", vcpus=2)]))
+    changes = diff_resources(previous, uid=UID, index=index)
+    assert changes == ResourceChanges(updated=[get_key("a")], removed=[get_key("b")])
+    assert index.resources[get_key("a")].data["vcpus"] == 2
+
+
+def test_added_resource() -> None:
+    previous = get_state(get_provider([get_flavor("a")]))
+    index = index_resources(get_provider([get_flavor("a"), get_flavor("b")]))
+    assert diff_resources(previous, uid=UID, index=index) is None
+
+
+def test_changed_relationship() -> None:
+    previous = get_state(get_provider([get_flavor("a", projects=["p1"])]))
+    index = index_resources(get_provider([get_flavor("a", projects=["p2"])]))
+    assert diff_resources(previous, uid=UID, index=index) is None
+
+
+def test_changed_base_provider() -> None:
+    previous = get_state(get_provider([get_flavor("a")]))
+    index = index_resources(get_provider([get_flavor("a")], status="maintenance"))
+    assert diff_resources(previous, uid=UID, index=index) is None
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+from scheduler import CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_opens_after_consecutive_failures(clock: Clock) -> None:
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure("site")
+    breaker.check("site")
+    breaker.record_failure("site")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("site")
+
+
+def test_success_resets_failures(clock: Clock) -> None:
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    breaker.record_failure("site")
+    breaker.record_success()
+    breaker.record_failure("site")
+    breaker.check("site")
+
+
+def test_half_open_after_reset_timeout(clock: Clock) -> None:
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure("site")
+    clock.now += 59
+    with pytest.raises(CircuitOpenError):
+        breaker.check("site")
+
+    # Calls go through again: a single failure opens the circuit again.
+    clock.now += 1
+    breaker.check("site")
+    breaker.record_failure("site")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("site")
+
+    # A success closes it.
+    clock.now += 60
+    breaker.check("site")
+    breaker.record_success()
+    breaker.record_failure("site")
+    breaker.check("site")
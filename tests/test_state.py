@@ -0,0 +1,26 @@
+import json
+
+from state import canonical_dumps, compute_digest
+
+
+def test_canonical_dumps_ignores_keys_and_items_order() -> None:
+    a = {"name": "p", "regions": [{"name": "r2", "ids": [3, 1]}, {"name": "r1"}]}
+    b = {"regions": [{"name": "r1"}, {"ids": [1, 3], "name": "r2"}], "name": "p"}
+    assert canonical_dumps(a) == canonical_dumps(b)
+    assert compute_digest(a) == compute_digest(b)
+
+
+def test_canonical_dumps_is_valid_json() -> None:
+    data = {"b": [{"y": None, "x": "é"}, 2.5], "a": True}
+    assert json.loads(canonical_dumps(data)) == {
+        "a": True,
+        "b": [2.5, {"x": "é", "y": None}],
+    }
+
+
+def test_compute_digest_detects_changes() -> None:
+    data = {"name": "p", "regions": [{"name": "r1"}]}
+    assert compute_digest(data) != compute_digest({**data, "name": "q"})
+    assert compute_digest(data) != compute_digest({**data, "regions": []})
+    # Values of different types don't collide.
+    assert compute_digest({"a": 1}) != compute_digest({"a": "1"})